@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src', 'preprocessing'))
+
+import count_reads
+import fixtures
+
+
+def time_it(fn, *args):
+
+    start = time.perf_counter()
+    output = fn(*args)
+    return time.perf_counter() - start, output
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Per-read Aligned_Read parsing vs block decoding of SAM records.')
+    parser.add_argument('-n', type = int, default = 1000000, help = 'number of SAM records')
+    parser.add_argument('-d', type = int, default = 2, help = 'edit distance')
+    parser.add_argument('-m', type = int, default = 10, help = 'minimum matches')
+    args = parser.parse_args()
+
+    count_reads.Aligned_Read.edit_distance = args.d
+    count_reads.Aligned_Read.min_matches = args.m
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = os.path.join(tmp_dir, 'fixture.sam')
+        reporter_seqs = fixtures.make_reporters(os.path.join(tmp_dir, 'reporters.fa'), 1000, spike_num = 0)
+        fixtures.make_sam(fpath, reporter_seqs, args.n, seq_error_rate = 0.02, cigar_variants = True)
+
+        per_read_time, (per_read_collector, read_num) = time_it(lambda: count_reads.count_mapped_reads(count_reads.iter_sam_text(fpath, 'sam'), fpath))
+        block_time, (block_collector, _) = time_it(count_reads.count_sam_blocks, fpath, 'sam')
+
+    if per_read_collector.reporter_dic != block_collector.reporter_dic:
+        raise Exception('Block decoder output does not match the per-read parser')
+
+    print(f'records: {read_num}')
+    print(f'per-read: {per_read_time:.2f} s ({read_num / per_read_time:.0f} reads/s)')
+    print(f'block:    {block_time:.2f} s ({read_num / block_time:.0f} reads/s)')
+    print(f'speed-up: {per_read_time / block_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
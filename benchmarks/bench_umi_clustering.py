@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src', 'preprocessing'))
+
+import count_unique
+import fixtures
+
+
+def simulate_reporter(molecule_num, umi_len = 10, mean_reads = 5, error_rate = 0.01, seed = 0):
+
+    '''
+    Simulates the reads of one reporter with fixtures.simulate_reads, about mean_reads reads per molecule. Returns the read UMIs
+    and the number of distinct true molecules among the reads.
+    '''
+
+    chunks = list(fixtures.simulate_reads(1, int(molecule_num * mean_reads), umi_len = umi_len, mean_reads = mean_reads, umi_error_rate = error_rate, true_umis = True, seed = seed))
+    umis = np.concatenate([u for _, u, _ in chunks]).view(f'S{umi_len}').ravel().tolist()
+    true_num = len(np.unique(np.concatenate([t for _, _, t in chunks]).view(f'S{umi_len}').ravel()))
+
+    return umis, true_num
+
+
+def brute_force_pairs(packed):
+
+    pairs = set()
+    packed = packed.tolist()
+
+    for i in range(len(packed)):
+        for j in range(i + 1, len(packed)):
+            z = packed[i] ^ packed[j]
+            if ((z | (z >> 1)) & 0x55555555).bit_count() == 1:
+                pairs.add(tuple([i, j]))
+
+    return pairs
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Compares UMI clustering methods on a simulated reporter.')
+    parser.add_argument('-n', type = int, default = 100000, help = 'number of molecules for the reporter')
+    parser.add_argument('-l', type = int, default = 12, help = 'UMI length')
+    parser.add_argument('-e', type = float, default = 0.01, help = 'substitution error rate per base')
+    parser.add_argument('-r', type = float, default = 5, help = 'mean reads per molecule')
+    parser.add_argument('--check', type = int, default = 2000, help = 'number of unique UMIs to check against brute force pairwise comparison')
+    args = parser.parse_args()
+
+    umis, true_num = simulate_reporter(args.n, umi_len = args.l, mean_reads = args.r, error_rate = args.e)
+    packed = count_unique.pack_umis(umis)
+    unique_umis = np.unique(packed)
+
+    subset = unique_umis[:args.check]
+    start = time.perf_counter()
+    pairs_i, pairs_j = count_unique.hamming1_pairs_packed(subset, args.l)
+    index_time = time.perf_counter() - start
+    start = time.perf_counter()
+    brute_pairs = brute_force_pairs(subset)
+    brute_time = time.perf_counter() - start
+
+    if set(tuple(sorted(p)) for p in zip(pairs_i.tolist(), pairs_j.tolist())) != brute_pairs:
+        raise Exception('Hamming-1 index does not match brute force pairwise comparison')
+
+    print(f'reads: {len(umis)}, unique umis: {len(unique_umis)}, true molecules: {true_num}')
+    print(f'hamming-1 pairs on {len(subset)} umis: index {index_time:.4f} s, pairwise {brute_time:.2f} s')
+
+    for method in count_unique.Umi_counter.methods:
+        count_unique.Umi_counter.method = method
+        start = time.perf_counter()
+        count = count_unique.Umi_counter(packed).total_count
+        elapsed = time.perf_counter() - start
+        print(f'{method:<12} count: {count:>8} ({count / true_num:.3f} of true), {elapsed:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+'''
+Deterministic synthetic NaP-TRAP fixtures: reporter fasta, sequencing reads (sam, bam, fastq), count json and build
+params in the layout of libraries/*/build_db.toml.
+'''
+
+import json
+import os
+
+import numpy as np
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+repo_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+bases = np.frombuffer(b'ACGT', dtype = np.uint8)
+chunk_size = 1 << 18
+
+
+def reporter_names(reporter_num, spike_num = 3):
+    return [f'reporter_{n}' for n in range(reporter_num)] + [f'ntrap_spike_{n}' for n in range(spike_num)]
+
+
+def make_reporters(fpath, reporter_num, insert_len = 60, spike_num = 3, seed = 0):
+
+    '''
+    Writes reporter_num random inserts tagged reporter and spike_num spike-ins tagged spikein, returns the sequences
+    as an (reporter_num + spike_num, insert_len) uint8 array.
+    '''
+
+    rng = np.random.default_rng(seed)
+    seqs = bases[rng.integers(0, 4, size = (reporter_num + spike_num, insert_len))]
+    names = reporter_names(reporter_num, spike_num)
+
+    with open(fpath, 'w') as f:
+        for n, (name, seq) in enumerate(zip(names, seqs)):
+            tag = 'reporter' if n < reporter_num else 'spikein'
+            f.write(f'>{name}#{tag}\n{seq.tobytes().decode()}\n')
+
+    return seqs
+
+
+def simulate_reads(reporter_num, read_num, umi_len = 10, mean_reads = 5, umi_error_rate = 0.001, true_umis = False, seed = 0):
+
+    '''
+    Yields chunks of (reporter index, UMI array) for read_num reads. Molecules get a random UMI and a reporter drawn
+    from log-normal abundances, reads are drawn uniformly from the molecules (PCR duplicates) and UMI bases are
+    substituted at umi_error_rate. With true_umis the error free UMIs of the reads are yielded as a third array.
+    '''
+
+    rng = np.random.default_rng(seed)
+    molecule_num = max(int(read_num // mean_reads), 1)
+    abundance = rng.lognormal(0, 1, size = reporter_num)
+    molecule_reporters = rng.choice(reporter_num, size = molecule_num, p = abundance / abundance.sum())
+    molecule_umis = rng.integers(0, 4, size = (molecule_num, umi_len), dtype = np.uint8)
+
+    for start in range(0, read_num, chunk_size):
+        n = min(chunk_size, read_num - start)
+        molecules = rng.integers(0, molecule_num, size = n)
+        umis = molecule_umis[molecules]
+        errors = rng.random(umis.shape) < umi_error_rate
+        umis[errors] = (umis[errors] + rng.integers(1, 4, size = errors.sum(), dtype = np.uint8)) % 4
+
+        if true_umis:
+            yield molecule_reporters[molecules], bases[umis], bases[molecule_umis[molecules]]
+        else:
+            yield molecule_reporters[molecules], bases[umis]
+
+
+def substitute(seqs, error_rate, rng):
+
+    errors = rng.random(seqs.shape) < error_rate
+    codes = np.searchsorted(bases, seqs[errors])
+    seqs[errors] = bases[(codes + rng.integers(1, 4, size = errors.sum())) % 4]
+
+    return seqs
+
+
+def make_sam(fpath, reporter_seqs, read_num, umi_len = 10, seq_error_rate = 0.001, cigar_variants = False, seed = 0):
+
+    '''
+    Single-end bowtie2-like sam of reads aligned end to end to their reporter, NM drawn at seq_error_rate per base.
+    With cigar_variants the cigar of each read is drawn from a full match, a 3 nt soft clip and a match with indels.
+    '''
+
+    names = reporter_names(len(reporter_seqs), 0)
+    insert_len = reporter_seqs.shape[1]
+    cigars = [f'{insert_len}M', f'3S{insert_len - 3}M', f'{insert_len - 6}M1I1M1D4M'] if cigar_variants else [f'{insert_len}M']
+    rng = np.random.default_rng(seed + 1)
+    read_id = 0
+
+    with open(fpath, 'w') as f:
+        f.write('@HD\tVN:1.0\tSO:unsorted\n')
+        for name in names:
+            f.write(f'@SQ\tSN:{name}\tLN:{insert_len}\n')
+        f.write('@PG\tID:bowtie2\tPN:bowtie2\tCL:"bowtie2 -x reporters -U reads.fq"\n')
+
+        for reporters, umis in simulate_reads(len(reporter_seqs), read_num, umi_len = umi_len, seed = seed):
+            nm = rng.binomial(insert_len, seq_error_rate, size = len(reporters))
+            cigar_idx = rng.integers(0, len(cigars), size = len(reporters)) if cigar_variants else np.zeros(len(reporters), dtype = int)
+            lines = []
+            for r, umi, e, c in zip(reporters.tolist(), umis.view(f'S{umi_len}').ravel().tolist(), nm.tolist(), cigar_idx.tolist()):
+                lines.append(f'read_{read_id}#{umi.decode()}\t0\t{names[r]}\t1\t42\t{cigars[c]}\t*\t0\t0\t*\t*\tAS:i:-{e}\tNM:i:{e}\tYT:Z:UU\n')
+                read_id += 1
+            f.write(''.join(lines))
+
+
+def make_bam(fpath, sam_path):
+
+    '''
+    Coordinate sorted, indexed bam of sam_path. Returns None if pysam is not installed.
+    '''
+
+    if pysam is None:
+        return None
+
+    pysam.sort('-o', fpath, sam_path)
+    pysam.index(fpath)
+
+    return fpath
+
+
+def make_fastq(fpath, reporter_seqs, read_num, umi_len = 10, seq_error_rate = 0.001, seed = 0):
+
+    '''
+    Reads starting with the reporter insert, UMI in the read name, bases substituted at seq_error_rate. Written zstd
+    compressed if fpath ends in .zst.
+    '''
+
+    rng = np.random.default_rng(seed + 2)
+    insert_len = reporter_seqs.shape[1]
+    quality = 'I' * insert_len
+    read_id = 0
+
+    if fpath.endswith('.zst'):
+        if zstandard is None:
+            raise Exception('python-zstandard is required for .zst fastq fixtures')
+        f = zstandard.ZstdCompressor().stream_writer(open(fpath, 'wb'))
+    else:
+        f = open(fpath, 'wb')
+
+    with f:
+        for reporters, umis in simulate_reads(len(reporter_seqs), read_num, umi_len = umi_len, seed = seed):
+            seqs = substitute(reporter_seqs[reporters], seq_error_rate, rng)
+            lines = []
+            for seq, umi in zip(seqs.view(f'S{insert_len}').ravel().tolist(), umis.view(f'S{umi_len}').ravel().tolist()):
+                lines.append(f'@read_{read_id}#{umi.decode()}\n{seq.decode()}\n+\n{quality}\n')
+                read_id += 1
+            f.write(''.join(lines).encode())
+
+
+def make_counts(fpath, reporter_num, run_names, spike_num = 3, seed = 0):
+
+    '''
+    count_reads style {run_name: {reporter_name: count}} json with negative binomial counts per reporter.
+    '''
+
+    rng = np.random.default_rng(seed + 3)
+    names = reporter_names(reporter_num, spike_num)
+    abundance = rng.lognormal(3, 1, size = len(names))
+    counts = {}
+
+    for run_name in run_names:
+        run_counts = rng.negative_binomial(5, 5 / (5 + abundance))
+        counts[run_name] = {name: c for name, c in zip(names, run_counts.tolist()) if c > 0}
+
+    json.dump(counts, open(fpath, 'w'))
+
+
+def make_build_params(tmp_dir, reporter_num, seed = 0):
+
+    '''
+    Writes the fasta, counts and selector of a one sample, two replicate NaP-TRAP experiment to tmp_dir and returns
+    build params with the constants of libraries/utr5_fish/build_db.toml.
+    '''
+
+    import toml
+
+    fasta_path = os.path.join(tmp_dir, 'reporters.fa')
+    counts_path = os.path.join(tmp_dir, 'counts.json')
+    selector_path = os.path.join(tmp_dir, 'selector.toml')
+    output_path = os.path.join(tmp_dir, 'output', '')
+    os.makedirs(os.path.join(output_path, 'tmp'), exist_ok = True)
+
+    runs = {'BENCH1': ['B1', 'input'], 'BENCH2': ['B2', 'input'], 'BENCH3': ['B1', 'flag_pulldown'], 'BENCH4': ['B2', 'flag_pulldown']}
+
+    make_reporters(fasta_path, reporter_num, seed = seed)
+    make_counts(counts_path, reporter_num, list(runs), seed = seed)
+
+    selectors = {'selectors': {'bench_6hpf': {'sample_names': ['bench_6hpf'], 'data_types': ['mean_translation'], 'read_filters': [['input', 'raw_count', '10']],
+                                              'features_to_include': [], 'features_to_exclude': [], 'filter_features': []}}}
+    toml.dump(selectors, open(selector_path, 'w'))
+
+    constants = toml.load(os.path.join(repo_path, 'libraries', 'utr5_fish', 'build_db.toml'))['constants']
+    constants['kozak_score_path'] = os.path.join(repo_path, constants['kozak_score_path'])
+
+    params = {
+        'paths': {'db_path': os.path.join(tmp_dir, 'bench.db'), 'schema_path': os.path.join(repo_path, 'doc', 'db_schema.sql'), 'output_path': output_path,
+                  'fasta_path': fasta_path, 'selector_path': selector_path},
+        'constants': constants,
+        'features': {'kmer_counter': [{'kmax': 3}], 'orf_finder': [{'start_codons': ['ATG']}]},
+        'analyses': {'enrichment': [{'rnum': 0.1, 'kmin': 1, 'kmax': 3}], 'feature_correlation': [{}]},
+        'data': {
+            'ignore_not_found': True,
+            'count_paths': {'bench': counts_path},
+            'functions': {'calculate_delta': [{'samples': ['bench_6hpf'], 'num_run_type': 'flag_pulldown', 'denom_run_type': 'input', 'data_type': 'translation'}]},
+            'spike_ins': {'bench_6hpf': {'spike_ins_to_exclude': ['ntrap_spike_2']}},
+            'samples': {'bench_6hpf': {'experiment_name': 'bench', 'collection_time': 6, 'library': '60A', 'organism': 'Danio rerio',
+                                       'runs': {r: {'replicate_name': rep, 'run_type': run_type} for r, (rep, run_type) in runs.items()}}}
+        }
+    }
+
+    return params
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+'''
+Times count_reads, count_unique.Umi_counter, build_db.make_db and the analyses on synthetic fixtures at several
+scales. With --history the results are appended to a json history keyed by git commit, nothing is written otherwise.
+
+    python benchmarks/run_benchmarks.py --scale small medium --history ~/mpra_bench_history.json --compare
+'''
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmark_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.join(benchmark_path, '..')
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.join(repo_path, 'src', 'preprocessing'))
+
+import numpy as np
+
+import count_reads
+import count_unique
+import fixtures
+
+scales = {
+    'tiny': {'reads': 10 ** 4, 'reporters': 10 ** 3},
+    'small': {'reads': 10 ** 5, 'reporters': 10 ** 3},
+    'medium': {'reads': 10 ** 6, 'reporters': 10 ** 4},
+    'large': {'reads': 10 ** 7, 'reporters': 10 ** 5},
+    'xlarge': {'reads': 10 ** 8, 'reporters': 10 ** 6},
+}
+
+suites = ['count_reads', 'umi_counter', 'make_db']
+
+
+def git_commit():
+
+    try:
+        commit = subprocess.run(['git', '-C', repo_path, 'rev-parse', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', '-C', repo_path, 'status', '--porcelain', '--untracked-files=no'], capture_output = True, text = True, check = True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, dirty
+
+
+def time_it(fn, *args, **kwargs):
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        output = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+    return elapsed, output
+
+
+def result(seconds, read_num = None, **kwargs):
+
+    r = {'seconds': seconds}
+
+    if read_num is not None:
+        r['reads_per_sec'] = read_num / max(seconds, 1e-9)
+
+    return r | kwargs
+
+
+def bench_count_reads(tmp_dir, read_num, reporter_num):
+
+    results = {}
+    run_path = os.path.join(tmp_dir, 'BENCH_run', 'aligned')
+    os.makedirs(run_path, exist_ok = True)
+
+    count_reads.tmp_path = tmp_dir
+    count_reads.reader = 'text'
+    count_reads.paired_end = False
+    count_reads.reporter_index = None
+    count_reads.Aligned_Read.edit_distance = 3
+    count_reads.Aligned_Read.min_matches = 1000
+
+    reporter_seqs = fixtures.make_reporters(os.path.join(tmp_dir, 'reporters.fa'), reporter_num, spike_num = 0)
+    sam_path = os.path.join(run_path, 'hits.sam')
+    fixtures.make_sam(sam_path, reporter_seqs, read_num)
+
+    seconds, _ = time_it(count_reads.read_accepted_hits, sam_path)
+    results['count_reads.sam_blocks'] = result(seconds, read_num)
+
+    bam_path = fixtures.make_bam(os.path.join(run_path, 'hits.bam'), sam_path)
+
+    if bam_path is not None:
+        count_reads.reader = 'binary'
+        seconds, _ = time_it(count_reads.read_accepted_hits, bam_path)
+        results['count_reads.bam_binary'] = result(seconds, read_num)
+        count_reads.reader = 'text'
+
+    fastq_path = os.path.join(tmp_dir, f'BENCH_reads.fastq{".zst" if fixtures.zstandard is not None else ""}')
+    fixtures.make_fastq(fastq_path, reporter_seqs, read_num)
+
+    seconds, _ = time_it(count_reads.read_fasta, fastq_path)
+    results['count_reads.fastq'] = result(seconds, read_num)
+
+    index_seconds, count_reads.reporter_index = time_it(count_reads.Reporter_index, os.path.join(tmp_dir, 'reporters.fa'))
+    seconds, _ = time_it(count_reads.read_fasta, fastq_path)
+    results['count_reads.fastq_reporters'] = result(seconds, read_num, index_seconds = index_seconds)
+    count_reads.reporter_index = None
+
+    return results
+
+
+def bench_umi_counter(read_num):
+
+    '''
+    Clusters the 12 nt UMIs of a single simulated reporter with min(read_num, 10^6) reads and 1% UMI base errors.
+    '''
+
+    results = {}
+    umis = np.concatenate([u for r, u in fixtures.simulate_reads(1, min(read_num, 10 ** 6), umi_len = 12, umi_error_rate = 0.01)])
+    umis = umis.view('S12').ravel().tolist()
+    packed = count_unique.pack_umis(umis)
+    method = count_unique.Umi_counter.method
+
+    for m in count_unique.Umi_counter.methods:
+        count_unique.Umi_counter.method = m
+        seconds, counter = time_it(count_unique.Umi_counter, packed)
+        results[f'umi_counter.{m}'] = result(seconds, len(umis), umi_count = counter.total_count)
+
+    count_unique.Umi_counter.method = method
+
+    return results
+
+
+def bench_make_db(tmp_dir, reporter_num):
+
+    import src.database.build_db as build_db
+    import src.database.mpra_db as mpra_db
+
+    results = {}
+    params = fixtures.make_build_params(tmp_dir, reporter_num)
+    analyses = params.pop('analyses')
+    selector_path = params['paths'].pop('selector_path')
+
+    db = mpra_db.MPRA_DB(db_path = params['paths']['db_path'], output_path = params['paths']['output_path'], schema_path = params['paths']['schema_path'])
+    seconds, db = time_it(build_db.make_db, db, params)
+    results['make_db.build'] = result(seconds, reporters = reporter_num)
+
+    seconds, _ = time_it(db.add_selectors, selector_path)
+    results['make_db.selectors'] = result(seconds, reporters = reporter_num)
+
+    seconds, _ = time_it(db.load_features, 'all', sparse = True)
+    results['make_db.load_features'] = result(seconds, reporters = reporter_num)
+
+    for analysis, arg_list in analyses.items():
+        seconds, _ = time_it(build_db.add_analysis, db, {analysis: arg_list})
+        results[f'analysis.{analysis}'] = result(seconds, reporters = reporter_num)
+
+    return results
+
+
+def run_scale(scale, selected_suites):
+
+    read_num = scales[scale]['reads']
+    reporter_num = scales[scale]['reporters']
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if 'count_reads' in selected_suites:
+            results |= bench_count_reads(tmp_dir, read_num, reporter_num)
+        if 'umi_counter' in selected_suites:
+            results |= bench_umi_counter(read_num)
+        if 'make_db' in selected_suites:
+            db_dir = os.path.join(tmp_dir, 'make_db')
+            os.makedirs(db_dir)
+            results |= bench_make_db(db_dir, reporter_num)
+
+    return results
+
+
+def previous_entry(history, commit, scale):
+
+    for entry in reversed(history):
+        if entry['commit'] != commit and entry['scale'] == scale:
+            return entry
+
+    return None
+
+
+def print_results(results, previous = None):
+
+    for name, r in results.items():
+        line = f'{name:<32} {r["seconds"]:>10.3f} s'
+        if 'reads_per_sec' in r:
+            line += f' {r["reads_per_sec"]:>12.0f} reads/s'
+        if previous is not None and name in previous['results']:
+            line += f'  ({previous["results"][name]["seconds"] / max(r["seconds"], 1e-9):.2f}x vs {previous["commit"][:8]})'
+        print(line)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks preprocessing, UMI collapsing, database builds and analyses on synthetic fixtures.')
+    parser.add_argument('--scale', nargs = '+', default = ['small'], choices = list(scales), help = 'reads/reporters presets: ' + ', '.join(f'{k}: {v["reads"]:.0e}/{v["reporters"]:.0e}' for k, v in scales.items()))
+    parser.add_argument('--suite', nargs = '+', default = suites, choices = suites, help = 'benchmarks to run')
+    parser.add_argument('--history', type = str, default = None, help = 'json history the results are appended to, results are not recorded without it')
+    parser.add_argument('--compare', action = 'store_true', help = 'compare with the last entry of another commit in the history')
+    args = parser.parse_args()
+
+    if args.compare and args.history is None:
+        parser.error('--compare needs --history')
+
+    #src modules load doc/ files relative to the repository root
+    history_path = os.path.abspath(os.path.expanduser(args.history)) if args.history is not None else None
+    os.chdir(repo_path)
+
+    commit, dirty = git_commit()
+    history = json.load(open(history_path, 'r')) if history_path is not None and os.path.exists(history_path) else []
+
+    for scale in args.scale:
+        print(f'scale: {scale}, reads: {scales[scale]["reads"]}, reporters: {scales[scale]["reporters"]}, commit: {commit}{" (dirty)" if dirty else ""}')
+        results = run_scale(scale, args.suite)
+        print_results(results, previous_entry(history, commit, scale) if args.compare else None)
+
+        history.append({'commit': commit, 'dirty': dirty, 'date': datetime.datetime.now().isoformat(timespec = 'seconds'), 'python': platform.python_version(),
+                        'machine': platform.node(), 'scale': scale, 'reads': scales[scale]['reads'], 'reporters': scales[scale]['reporters'],
+                        'suites': args.suite, 'results': results})
+
+    if history_path is not None:
+        json.dump(history, open(history_path, 'w'), indent = 1)
+
+
+if __name__ == '__main__':
+    main()
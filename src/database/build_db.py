@@ -1,4 +1,6 @@
+import json
 import argparse
+import contextlib
 import toml
 import pyfaidx
 import warnings
@@ -85,30 +87,51 @@ def add_analysis(db, analysis_params):
 
 def make_db(db, params):
 
+    '''
+    With query_profile_path in [paths] the queries of each build stage are profiled, the ranked report is printed and
+    written to query_profile_path as json.
+    '''
+
+    query_profile_path = params['paths'].get('query_profile_path')
+
+    with db.profiling() if query_profile_path is not None else contextlib.nullcontext() as profile:
+
+        with db.bulk_load():
+
+            if db.reporter_num is None:
+                with db.profile_stage('reporters'):
+                    fasta_path = params['paths']['fasta_path']
+                    add_reporters(db,fasta_path = fasta_path)
+                    add_constants(db, params['constants'])
+
+            if 'data' in params:
+                with db.profile_stage('data'):
+                    add_data(db, params['data'])
+            else:
+                warnings.warn('data section not found in params.')
+
+            if 'features' in params:
+                with db.profile_stage('features'):
+                    add_features(db, params['features'])
+            else:
+                warnings.warn('feature section not found in params.')
 
-    if db.reporter_num is None:
-        fasta_path = params['paths']['fasta_path']
-        add_reporters(db,fasta_path = fasta_path)
-        add_constants(db, params['constants'])
+        if 'selector_path' in params['paths'] and 'analyses' in params:
+            selector_path = params['paths']['selector_path']
 
-    if 'data' in params:
-        add_data(db, params['data'])
-    else:
-        warnings.warn('data section not found in params.')
+            with db.profile_stage('selectors'):
+                db.add_selectors(selector_path)
+                db.load_features('all')
 
-    if 'features' in params:
-        add_features(db, params['features'])
-    else:
-        warnings.warn('feature section not found in params.')
+            with db.profile_stage('analyses'):
+                add_analysis(db, params['analyses'])
 
-    if 'selector_path' in params['paths'] and 'analyses' in params:
-        selector_path = params['paths']['selector_path']
-        db.add_selectors(selector_path)
-        db.load_features('all')
-        add_analysis(db, params['analyses'])
+        else:
+            warnings.warn('analyses section or selector_path not found in params.')
 
-    else:
-        warnings.warn('analyses section or selector_path not found in params.')
+    if profile is not None:
+        print(profile.report())
+        json.dump(profile.to_dict(), open(query_profile_path, 'w'), indent = 1)
 
     return db
 
@@ -1,88 +1,121 @@
 import os
+import re
+import sys
+import time
+import json
+import queue
+import pathlib
 import sqlite3
 import hashlib
 import itertools
+import collections
+import contextlib
+import concurrent.futures
 
 import pandas as pd
 import numpy as np
+import scipy.sparse
 import logging
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 
 class DB_Column:
 
     '''
     Class to mangage column conditionals when using Select_to_SQL.where() method.
     Each column in the database has a corresponding DB_Column object.
+    Values are not written into the sql string, each conditional keeps a list of parameters bound to its ? placeholders.
 
     Example:
 
     a and b are DB_Column objects
 
     (a == 1)
-    Results in the following sql string: 'a.name = 1'
+    Results in the following sql string: 'a = ?' with parameters [1]
 
     (a > 1) & (colB < 2)
-    Results in the following sql string: 'a > 1 AND b < 2'
+    Results in the following sql string: 'a > ? AND b < ?' with parameters [1, 2]
+
+    a.in_([1,2,3])
+    Results in the following sql string: 'a IN (?,?,?)' with parameters [1, 2, 3], sets larger than max_in_params
+    result in 'a IN (SELECT value FROM json_each(?))' with the values as one json array parameter.
     '''
 
+    max_in_params = 64
+
     def __init__(self, name):
         self.name = name
         self.sql_str = []
+        self.params = []
         self.all_names = [name]
 
     def get_sql_str(self):
-        sql_str = self.sql_str
+        sql_str, params = self.sql_str, self.params
         if len(self.sql_str) > 1:
             raise Exception(f'Invalid sql string: {sql_str}')
         elif len(self.sql_str) == 0:
-            return self.name
+            return self.name, []
         else:
             self.sql_str = []
-            return sql_str[0]
+            self.params = []
+            return sql_str[0], params[0]
 
     def type_check(self, other):
+        if isinstance(other, np.generic):
+            other = other.item()
         if type(other) not in [int, float, str, DB_Column]:
             raise Exception(f'Invalid type: {type(other)}')
-        elif type(other) == str:
-            other = f'"{other}"'
         elif type(other) == DB_Column:  
             self.all_names += other.all_names
-            other = other.get_sql_str()
-        return other
+            return other.get_sql_str()
+        return '?', [other]
 
-    def return_sql_str(self, other, condition):
-        other = self.type_check(other)
-        self.sql_str.append(f'{self.name} {condition} {other}')
+    def add_sql_str(self, sql_str, params):
+        self.sql_str.append(sql_str)
+        self.params.append(params)
         return self
+
+    def return_sql_str(self, other, condition):
+        other, params = self.type_check(other)
+        return self.add_sql_str(f'{self.name} {condition} {other}', params)
     
     def between(self, lower, upper):
-        self.sql_str.append(f'{self.name} BETWEEN {lower} AND {upper}')
-        return self
+        lower, lower_params = self.type_check(lower)
+        upper, upper_params = self.type_check(upper)
+        return self.add_sql_str(f'{self.name} BETWEEN {lower} AND {upper}', lower_params + upper_params)
      
     def like(self, other, exclude = False):
-        other =  self.type_check(other)
+        other, params = self.type_check(other)
         if exclude:
-            self.sql_str.append(f"{self.name} NOT LIKE {other}")
+            return self.add_sql_str(f"{self.name} NOT LIKE {other}", params)
         else:
-            self.sql_str.append(f"{self.name} LIKE {other}")
-        return self
+            return self.add_sql_str(f"{self.name} LIKE {other}", params)
     
     def length(self):
         self.name = f'LENGTH({self.name})'
         return self
 
+    def count(self, distinct = False):
+        self.name = f'COUNT(DISTINCT {self.name})' if distinct else f'COUNT({self.name})'
+        return self
+
     def in_(self, other, exclude = False):
         if not (type(other) == list or type(other) == tuple or type(other) == set):
             raise Exception(f'Invalid type: {type(other)}')
         
-        other = ','.join([f'"{o}"' if type(o) == str else str(o) for o in other])
+        other = list(dict.fromkeys(o.item() if isinstance(o, np.generic) else o for o in other))
+        operator = 'NOT IN' if exclude else 'IN'
 
-        if not exclude:
-            self.sql_str.append(f'{self.name} IN ({other})')
+        #small sets get one placeholder per value so the planner knows their size, larger sets are bound as one json
+        #array so the sql string is the same for any number of values
+        if len(other) <= self.max_in_params:
+            return self.add_sql_str(f'{self.name} {operator} ({",".join("?" * len(other))})', other)
         else:
-            self.sql_str.append(f'{self.name} NOT IN ({other})')
-   
-        return self
+            return self.add_sql_str(f'{self.name} {operator} (SELECT value FROM json_each(?))', [json.dumps(other)])
 
     def __and__(self, other):
         if other is not self:
@@ -91,25 +124,31 @@ class DB_Column:
             if 'OR' in other.sql_str[0]:
                 other.sql_str = ['(' + other.sql_str[0] + ')']
             self.sql_str += other.sql_str
+            self.params += other.params
             other.sql_str = []
+            other.params = []
             self.all_names.append(other.name)
         
         if len(self.sql_str) < 2:
             raise Exception('Must use & between two conditionals')
         
         self.sql_str = [' AND '.join(self.sql_str)]
+        self.params = [[p for params in self.params for p in params]]
         return self
         
     def __or__(self, other):
         if other is not self:
             self.sql_str += other.sql_str
+            self.params += other.params
             other.sql_str = []
+            other.params = []
             self.all_names.append(other.name)
 
         if len(self.sql_str) < 2:
             raise Exception('Must use | between two conditionals')
         
         self.sql_str = [' OR '.join(self.sql_str)]
+        self.params = [[p for params in self.params for p in params]]
         return self
 
     def __add__(self, other):
@@ -163,6 +202,10 @@ class Select_to_SQL:
     s[['a','b']].where((s['a'] == 1) & (s['b'] < 2))
 
     generates: SELECT a,b FROM table_name WHERE a = 1 AND  b < 2
+
+    s[['a']].groupby(['a']).having(s['b'].count(distinct = True) == 2)
+
+    generates: SELECT a FROM table_name GROUP BY a HAVING COUNT(DISTINCT b) = 2
     '''
  
     def __init__(self):
@@ -174,7 +217,11 @@ class Select_to_SQL:
         self.select_table = None
         self.joins = []
         self.where_str = None
+        self.select_params = []
+        self.where_params = []
         self.columns_to_group = None
+        self.having_str = None
+        self.having_params = []
         self.orderby_str = None
         self.limit_str = None
         self.query_columns = []
@@ -195,18 +242,19 @@ class Select_to_SQL:
             raise Exception('Must provide select statement')
         else:
             if ambiguous_col is not None:
-                sql_query = ' '.join([self.replace_amibiguous_columns(s, ambiguous_col) for s in [self.where_str, self.groupby_str, self.orderby_str] if s is not None])
+                sql_query = ' '.join([self.replace_amibiguous_columns(s, ambiguous_col) for s in [self.where_str, self.groupby_str, self.having_str, self.orderby_str] if s is not None])
                 select_str = self.replace_amibiguous_columns(self.select_str, ambiguous_col)
                 sql_query = [s for s in [select_str, self.join_str,  sql_query, self.limit_str] if s is not None]
             else:
-                sql_query = [self.select_str, self.join_str, self.where_str, self.groupby_str, self.orderby_str, self.limit_str] 
+                sql_query = [self.select_str, self.join_str, self.where_str, self.groupby_str, self.having_str, self.orderby_str, self.limit_str] 
                 sql_query = [s for s in sql_query if s is not None]
 
             sql_str = ' '.join(sql_query)
             select_columns = self.select_columns
+            params = tuple(self.select_params + self.where_params + self.having_params)
             if reset_query:
                 self.reset_query()
-            return sql_str, select_columns
+            return sql_str, select_columns, params
         
     def fix_column_call(self, tmp_str, ambiguous_col):
         for c in ambiguous_col:
@@ -216,7 +264,8 @@ class Select_to_SQL:
     def where(self, col_obj):
         if self.where_str is None:
             self.query_columns += col_obj.all_names
-            self.where_str = 'WHERE ' + col_obj.get_sql_str()
+            where_str, self.where_params = col_obj.get_sql_str()
+            self.where_str = 'WHERE ' + where_str
         else:
             raise Exception('Where statement already exists')
         return self
@@ -246,7 +295,9 @@ class Select_to_SQL:
             return cord
         elif type(cord) == DB_Column:
             self.query_columns += cord.all_names
-            return cord.get_sql_str()
+            sql_str, params = cord.get_sql_str()
+            self.select_params += params
+            return sql_str
         else:
             raise Exception(f'Invalid type: {type(cord)}')
 
@@ -309,7 +360,7 @@ class Select_to_SQL:
                 self.column_concat = column_list
                 
             for col in column_list:
-                self.select_columns.append(f'{fn}({col})')
+                self.select_columns.append(f'COUNT(DISTINCT {col})' if fn == 'count_distinct' else f'{fn}({col})')
                 if col not in self.query_columns:
                     self.query_columns.append(col)
 
@@ -333,6 +384,17 @@ class Select_to_SQL:
 
         return self
 
+    def having(self, col_obj):
+        if self.columns_to_group is None:
+            raise Exception('Having statement requires a groupby statement')
+        if self.having_str is None:
+            self.query_columns += col_obj.all_names
+            having_str, self.having_params = col_obj.get_sql_str()
+            self.having_str = 'HAVING ' + having_str
+        else:
+            raise Exception('Having statement already exists')
+        return self
+
     def orderby(self, order_list, ascending = True):
         self.query_columns += order_list
         order_str = ' ASC' if ascending else ' DESC'
@@ -376,6 +438,314 @@ class Select_to_SQL:
 
 
 
+class Query(collections.namedtuple('Query', ['sql', 'params', 'columns', 'tables'])):
+
+    '''
+    A compiled selection: the sql, the values bound to its ? placeholders, the selected columns and the tables it reads.
+    Queries hold no connection or query builder state, so they can be built once and run from threads or worker processes:
+
+    query = db.select(['reporter_id']).where(db['reporter_group_id'] == 1).to_query()
+    '''
+
+    __slots__ = ()
+
+
+
+class Connection_pool:
+
+    '''
+    A pool of read-only (mode=ro) connections to db_path that runs Query objects concurrently. sqlite3 releases the GIL while a
+    statement runs, so a thread pool is enough. Worker processes can open a Connection_pool of their own and run the same queries.
+
+    with db.read_pool() as pool:
+        group_reporter_ids = pool.map(queries, flatten = True)
+    '''
+
+    def __init__(self, db_path, size = 4, timeout = 60, on_close = None):
+
+        if db_path == ':memory:' or not os.path.exists(db_path):
+            raise Exception(f'Read-only connections need a database file, {db_path} not found!')
+
+        self.db_path = db_path
+        self.size = size
+        self.on_close = on_close
+        self.all_connections = []
+        self.connections = queue.Queue()
+        uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+
+        for n in range(size):
+            conn = sqlite3.connect(uri, uri = True, timeout = timeout, check_same_thread = False)
+            self.all_connections.append(conn)
+            self.connections.put(conn)
+
+
+    @contextlib.contextmanager
+    def connection(self):
+
+        conn = self.connections.get()
+
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+
+    def execute(self, query, number_to_fetch = 'all', flatten = False):
+
+        '''
+        Runs query on a free connection. number_to_fetch is 'all', 1 (the first value of the first row, None without rows) or
+        the number of rows to fetch. With flatten single column rows are returned as a list of values like DB_SQLite.to_list.
+        '''
+
+        logging.debug(f'{query.sql} {str(query.params)[:200]}' if len(query.params) > 0 else query.sql)
+
+        with self.connection() as conn:
+            cursor = conn.execute(query.sql, query.params)
+
+            try:
+                if number_to_fetch == 'all':
+                    rows = cursor.fetchall()
+                elif number_to_fetch == 1:
+                    row = cursor.fetchone()
+                    return None if row is None else row[0]
+                elif type(number_to_fetch) == int:
+                    rows = cursor.fetchmany(number_to_fetch)
+                else:
+                    raise Exception(f'Invalid number to fetch: {number_to_fetch}. Must be an integer or all')
+            finally:
+                cursor.close()
+
+        if flatten and len(query.columns) == 1:
+            return [r[0] for r in rows]
+
+        return rows
+
+
+    def map(self, queries, number_to_fetch = 'all', flatten = False):
+
+        '''
+        Runs the queries concurrently, one thread per connection, and returns their results in the order of queries.
+        '''
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.size) as executor:
+            return list(executor.map(lambda q: self.execute(q, number_to_fetch, flatten), queries))
+
+
+    def close(self):
+
+        '''
+        Closes the connections, then calls on_close (once) if the pool was given one.
+        '''
+
+        for conn in self.all_connections:
+            conn.close()
+
+        self.all_connections = []
+
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+class Query_cache:
+
+    '''
+    LRU cache of query results keyed on (sql, params, number_to_fetch). Each entry is filed under the tables its sql reads,
+    invalidate drops the entries of the tables that were written. Results with more than max_rows rows are not cached.
+    '''
+
+    def __init__(self, size = 256, max_rows = 1 << 16):
+
+        self.size = size
+        self.max_rows = max_rows
+        self.results = collections.OrderedDict()
+        self.table_keys = collections.defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+    def get(self, key):
+
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return True, self.results[key][1]
+
+        self.misses += 1
+        return False, None
+
+
+    def put(self, key, tables, result):
+
+        if self.size == 0 or (type(result) == list and len(result) > self.max_rows):
+            return
+
+        self.results[key] = (tables, result)
+        self.results.move_to_end(key)
+
+        for t in tables:
+            self.table_keys[t].add(key)
+
+        while len(self.results) > self.size:
+            self.drop(next(iter(self.results)))
+
+
+    def drop(self, key):
+
+        tables, _ = self.results.pop(key)
+
+        for t in tables:
+            self.table_keys[t].discard(key)
+
+
+    def invalidate(self, table_names):
+
+        for t in table_names:
+            for key in list(self.table_keys.pop(t, ())):
+                if key in self.results:
+                    self.drop(key)
+                    self.invalidations += 1
+
+
+    def clear(self):
+
+        self.results.clear()
+        self.table_keys.clear()
+
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0, 'entries': len(self.results), 'invalidations': self.invalidations}
+
+
+
+
+class Query_profile:
+
+    '''
+    Compile, execution and materialisation (to_numpy, to_dict, ...) time, rows and cache hits of the queries run while
+    profiling, aggregated by build stage, call site (the first caller outside db_to_sqlite) and sql, with the
+    EXPLAIN QUERY PLAN of each sql. Queries slower than slow_seconds are logged as warnings.
+    '''
+
+    def __init__(self, explain = True, slow_seconds = 1.0):
+
+        self.explain = explain
+        self.slow_seconds = slow_seconds
+        self.start = time.perf_counter()
+        self.current_stage = None
+        self.stages = {}
+        self.queries = {}
+        self.plans = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        '''
+        Files the queries of the enclosed block under stage name.
+        '''
+
+        previous = self.current_stage
+        self.current_stage = name
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+            self.current_stage = previous
+
+    def call_site(self):
+
+        frame = sys._getframe(1)
+
+        while frame is not None and frame.f_globals.get('__name__') in (__name__, 'contextlib'):
+            frame = frame.f_back
+
+        if frame is None:
+            return 'unknown'
+
+        return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}'
+
+    def add(self, sql_str, compile_seconds = 0, execute_seconds = 0, rows = 0, cached = False):
+
+        key = (self.current_stage, self.call_site(), sql_str)
+
+        if key not in self.queries:
+            self.queries[key] = {'calls': 0, 'cache_hits': 0, 'rows': 0, 'compile': 0, 'execute': 0, 'materialise': 0}
+
+        q = self.queries[key]
+        q['calls'] += 1
+        q['cache_hits'] += int(cached)
+        q['rows'] += rows
+        q['compile'] += compile_seconds
+        q['execute'] += execute_seconds
+
+        if execute_seconds > self.slow_seconds:
+            logging.warning(f'Slow query ({execute_seconds:.2f} s) at {key[1]}: {sql_str}')
+
+        return key
+
+    def materialised(self, key, seconds, rows = None):
+
+        self.queries[key]['materialise'] += seconds
+
+        if rows is not None:
+            self.queries[key]['rows'] += rows
+
+    def to_dict(self):
+
+        queries = []
+
+        for (stage, call_site, sql_str), q in self.queries.items():
+            queries.append({'stage': stage, 'call_site': call_site, 'sql': sql_str} | q | {'seconds': q['compile'] + q['execute'] + q['materialise'], 'plan': self.plans.get(sql_str, [])})
+
+        queries = sorted(queries, key = lambda q: q['seconds'], reverse = True)
+        stage_queries = collections.Counter()
+
+        for q in queries:
+            stage_queries[q['stage']] += q['seconds']
+
+        return {'wall_time': time.perf_counter() - self.start, 'stages': {s: {'seconds': t, 'query_seconds': stage_queries[s]} for s, t in self.stages.items()}, 'queries': queries}
+
+    def report(self, top = 20):
+
+        '''
+        Returns the stages and the top queries ranked by total time as text.
+        '''
+
+        profile = self.to_dict()
+        lines = [f'{"stage":<24} {"seconds":>10} {"in queries":>12}']
+
+        for s, t in profile['stages'].items():
+            lines.append(f'{s:<24} {t["seconds"]:>10.3f} {t["query_seconds"]:>12.3f}')
+
+        lines.append('')
+        lines.append(f'{"seconds":>10} {"compile":>9} {"execute":>9} {"material":>9} {"calls":>7} {"hits":>6} {"rows":>10}  stage / call site / sql')
+
+        for q in profile['queries'][:top]:
+            lines.append(f'{q["seconds"]:>10.3f} {q["compile"]:>9.3f} {q["execute"]:>9.3f} {q["materialise"]:>9.3f} {q["calls"]:>7} {q["cache_hits"]:>6} {q["rows"]:>10}  {q["stage"]} / {q["call_site"]}')
+            lines.append(f'{"":>12}{q["sql"][:200]}')
+
+            for p in q['plan']:
+                lines.append(f'{"":>14}{p}')
+
+        return '\n'.join(lines)
+
+
+
+
 class DB_SQLite(Select_to_SQL):
 
     '''
@@ -399,6 +769,15 @@ class DB_SQLite(Select_to_SQL):
         str: 'TEXT',
         bytes: 'BLOB'
         }
+
+    bulk_loading = False
+
+    #secondary indexes created by create_indexes, {index_name: (table_name, columns)}
+    index_specs = {}
+
+    #entries and maximum rows of the results cached by execute, cache_size = 0 turns the cache off
+    cache_size = 256
+    cache_max_rows = 1 << 16
     
     def __init__(self, db_path, schema_path = None, log_status = True, log_path = None, log_level = logging.DEBUG):
 
@@ -430,9 +809,15 @@ class DB_SQLite(Select_to_SQL):
     
         self.conn = sqlite3.connect(db_path)
         self.cursor = self.conn.cursor()
+        self.query_cache = Query_cache(self.cache_size, self.cache_max_rows)
+        self.cache_changes = self.conn.total_changes
+        self.query_profile = None
+        self.profile_key = None
+        self.compile_seconds = 0
         self.get_foriegn_keys()
         self.build_column_lookups()
         self.update_table_conn()
+        self.build_join_paths()
 
 
         super().__init__()
@@ -461,9 +846,11 @@ class DB_SQLite(Select_to_SQL):
         else:
             self.cursor.execute(f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(sql_columns)})')
 
+        self.invalidate([table_name, 'sqlite_master'])
 
         self.get_foriegn_keys()
         self.build_column_lookups()
+        self.build_join_paths()
 
 
     def check_for_ambiguous_columns(self, columns_to_check, table_list):
@@ -492,6 +879,7 @@ class DB_SQLite(Select_to_SQL):
 
     def execute_selection(self, reset_query = True):
 
+        start = time.perf_counter()
         tables, join_str = self.get_tables(self.query_columns)
         self.add_table_to_query(tables[0])
 
@@ -506,39 +894,198 @@ class DB_SQLite(Select_to_SQL):
             self.add_joins(join_str)   
 
         
-        sql_str, select_columns = self.get_sql_query(ambiguous_col = ambiguous_col, reset_query = reset_query)
+        sql_str, select_columns, params = self.get_sql_query(ambiguous_col = ambiguous_col, reset_query = reset_query)
+        self.compile_seconds = time.perf_counter() - start
+
+        return sql_str, select_columns, params
+
+
+    def to_query(self):
+
+        '''
+        Compiles the current selection into an immutable Query and resets the query builder.
+        '''
+
+        sql_str, select_columns, params = self.execute_selection(reset_query = False)
+        tables = tuple(self.tables_added)
+        self.reset_query()
+
+        return Query(sql_str, params, tuple(select_columns), tables)
+
+
+    def read_pool(self, size = 4, wal = False):
+
+        '''
+        Returns a Connection_pool of size read-only connections to the database. The open transaction is committed first, as
+        the pool only sees committed rows (and no temporary tables); inside bulk_load the transaction of the load is left open, so
+        the pool sees the database as it was before the load. With wal the database is switched to WAL journaling so the
+        pool can read while this connection writes, the previous journal mode is restored when the pool is closed.
+        '''
+
+        if self.conn.in_transaction and not self.bulk_loading:
+            self.conn.commit()
+
+        journal_mode = self.execute('PRAGMA journal_mode', 1)
+
+        if not wal or self.bulk_loading or journal_mode == 'wal':
+            return Connection_pool(self.db_path, size)
+
+        #the mode change holds its lock until the statement is fetched
+        self.execute('PRAGMA journal_mode = WAL', 'all')
+
+        def restore_journal_mode():
+            if self.conn.in_transaction:
+                self.conn.commit()
+            #a read first opens the -wal file the pool created, so the mode change checkpoints and removes it
+            self.execute('PRAGMA schema_version', 'all')
+            self.execute(f'PRAGMA journal_mode = {journal_mode}', 'all')
 
-        return sql_str, select_columns
+        return Connection_pool(self.db_path, size, on_close = restore_journal_mode)
 
 
-    def execute(self, sql_str = None, number_to_fetch = None):
+    def execute(self, sql_str = None, number_to_fetch = None, params = ()):
+
+        '''
+        Executes sql_str with the parameters bound to its ? placeholders, or the current selection if sql_str is None.
+        Fetched SELECT results are served from query_cache until a table they read is written by insert, new_table or drop_table.
+        Rows changed by any other statement on this connection (e.g. a raw UPDATE on self.cursor) clear the whole cache, see check_changes.
+        '''
 
         if sql_str is None:
-            sql_str, select_columns = self.execute_selection()
+            sql_str, select_columns, params = self.execute_selection()
 
-        logging.debug(sql_str)
+        cache_key = None
+
+        if number_to_fetch is not None and sql_str.lstrip()[:6].upper() == 'SELECT':
+            self.check_changes()
+            cache_key = (sql_str, tuple(params), number_to_fetch)
+            found, result = self.query_cache.get(cache_key)
+            if found:
+                if self.query_profile is not None:
+                    self.profile_query(sql_str, params, 0, len(result) if type(result) == list else 1, cached = True)
+                return list(result) if type(result) == list else result
+
+        logging.debug(f'{sql_str} {str(params)[:200]}' if len(params) > 0 else sql_str)
+        start = time.perf_counter()
 
         if number_to_fetch == 'all':
-            return self.cursor.execute(sql_str).fetchall()
+            result = self.cursor.execute(sql_str, params).fetchall()
         elif type(number_to_fetch) == int:
             if number_to_fetch == 1:
-                return self.cursor.execute(sql_str).fetchone()[0]
+                result = self.cursor.execute(sql_str, params).fetchone()[0]
             else:
-                return self.cursor.execute(sql_str).fetchmany(number_to_fetch)
+                result = self.cursor.execute(sql_str, params).fetchmany(number_to_fetch)
 
         elif number_to_fetch is None:
-            self.cursor.execute(sql_str)
+            self.cursor.execute(sql_str, params)
+            if self.query_profile is not None:
+                self.profile_query(sql_str, params, time.perf_counter() - start, 0)
+            return
         else:
             error_message = f'Invalid number to fetch: {number_to_fetch}. Must be an integer, None, or all'
             logging.debug(error_message)
             raise Exception(error_message)
 
+        if self.query_profile is not None:
+            self.profile_query(sql_str, params, time.perf_counter() - start, len(result) if type(result) == list else 1)
+
+        if cache_key is not None:
+            self.query_cache.put(cache_key, tuple(set(re.findall(r'\b(?:FROM|JOIN)\s+(\w+)', sql_str, flags = re.IGNORECASE))), result)
+            return list(result) if type(result) == list else result
+
+        return result
+
+
+    @contextlib.contextmanager
+    def profiling(self, explain = True, slow_seconds = 1.0):
+
+        '''
+        Profiles the queries run in the enclosed block:
+
+        with db.profiling() as profile:
+            with profile.stage('features'):
+                ...
+        print(profile.report())
+        '''
+
+        previous = self.query_profile
+        self.query_profile = Query_profile(explain = explain, slow_seconds = slow_seconds)
+
+        try:
+            yield self.query_profile
+        finally:
+            self.query_profile = previous
+
+
+    def profile_stage(self, name):
+
+        '''
+        Query_profile.stage while profiling, otherwise a no-op context.
+        '''
+
+        if self.query_profile is None:
+            return contextlib.nullcontext()
+
+        return self.query_profile.stage(name)
+
+
+    def profile_query(self, sql_str, params, execute_seconds, rows, cached = False):
+
+        '''
+        Adds a query to query_profile with the compile time of the last execute_selection. The plan is explained on a cursor of
+        its own, so a result pending on self.cursor is not lost.
+        '''
+
+        profile = self.query_profile
+
+        if profile.explain and sql_str not in profile.plans and sql_str.lstrip()[:6].upper() == 'SELECT':
+            try:
+                profile.plans[sql_str] = [r[3] for r in self.conn.execute(f'EXPLAIN QUERY PLAN {sql_str}', params).fetchall()]
+            except sqlite3.Error:
+                profile.plans[sql_str] = []
+
+        self.profile_key = profile.add(sql_str, compile_seconds = self.compile_seconds, execute_seconds = execute_seconds, rows = rows, cached = cached)
+        self.compile_seconds = 0
+
+
+    def profile_materialise(self, key, start, rows = None):
+
+        if self.query_profile is not None and key is not None:
+            self.query_profile.materialised(key, time.perf_counter() - start, rows)
+
+
+    def invalidate(self, table_names):
+
+        '''
+        Drops the cached results that read any of table_names, for writes that do not go through insert, new_table or drop_table.
+        '''
+
+        self.query_cache.invalidate([table_names] if type(table_names) == str else table_names)
+
+
+    def check_changes(self):
+
+        '''
+        Clears query_cache if conn.total_changes moved since the last write the cache accounted for, i.e. rows were inserted,
+        updated or deleted by a statement that did not go through insert (which invalidates exactly the table it writes).
+        '''
+
+        if self.conn.total_changes != self.cache_changes:
+            self.query_cache.clear()
+            self.cache_changes = self.conn.total_changes
+
+
+    @property
+    def cache_stats(self):
+        return self.query_cache.stats
+
 
 
     def to_list(self):
 
-        sql_str, select_columns = self.execute_selection()
-        q = self.execute(sql_str= sql_str, number_to_fetch = 'all')
+        sql_str, select_columns, params = self.execute_selection()
+        q = self.execute(sql_str= sql_str, number_to_fetch = 'all', params = params)
+        key, start = self.profile_key, time.perf_counter()
 
         try:
             qlen = len(q[0])
@@ -546,75 +1093,198 @@ class DB_SQLite(Select_to_SQL):
             self.reset_query()
             raise Exception(f'{sql_str} \n This selector is not valid!')
 
-        if qlen == 1:
-            return [s for e in q for s in e]
-        else:
-            return [tuple(e) for e in q]
+        output = [s for e in q for s in e] if qlen == 1 else [tuple(e) for e in q]
+        self.profile_materialise(key, start)
+
+        return output
             
 
 
-    def to_numpy(self, column_ids = 'all', row_ids = 'all', column_key = None, row_key = None):
+    def to_numpy(self, column_ids = 'all', row_ids = 'all', column_key = None, row_key = None, chunk_size = 1 << 16, sparse = False):
+
+        '''
+        Returns row_lookup, column_lookup, X for a db.select(columns = [row_identifier, column_identifier, value]) query.
+        With 'all' the identifiers are the indexes of X, otherwise the identifiers (or their row_key/column_key) are
+        numbered in order of first appearance. Rows are fetched in chunks of chunk_size into arrays and X is filled
+        with a single assignment. With sparse X is a scipy.sparse.csr_matrix built from the same arrays, without the
+        zero values (duplicate row, column pairs are summed instead of overwritten).
+        '''
 
-        sql_str, select_columns = self.execute_selection()
-        row_identifer = select_columns[0]
-        column_identifer = select_columns[1]
+        sql_str, select_columns, params = self.execute_selection()
 
         if len(select_columns) != 3:
             raise Exception('Please structure query so as follows: db.select(columns = [row_identifier, column_identifier, value])')
-        
-        column_num = self.get_max(column_identifer) + 1 if column_ids == 'all' else len(column_ids) 
+
+        self.execute(sql_str = sql_str, params = params)
+        key, start = self.profile_key, time.perf_counter()
+        row_chunks, column_chunks, value_chunks = [], [], []
+        row_dtype = np.dtype([('row', np.int64), ('column', np.int64), ('value', np.float64)])
+
+        while True:
+            rows = self.cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+
+            try:
+                rows = np.fromiter(rows, dtype = row_dtype, count = len(rows))
+                ridx, cidx, value = rows['row'], rows['column'], rows['value']
+            except (TypeError, ValueError):
+                #identifiers that are not integers or NULL values
+                ridx, cidx, value = zip(*rows)
+                ridx, cidx, value = np.array(ridx), np.array(cidx), np.array(value, dtype = np.float64)
+
+            row_chunks.append(ridx)
+            column_chunks.append(cidx)
+            value_chunks.append(value)
+
+        if len(value_chunks) == 0:
+            row_chunks, column_chunks, value_chunks = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)], [np.zeros(0)]
+
+        output = self.arrays_to_numpy(np.concatenate(row_chunks), np.concatenate(column_chunks), np.concatenate(value_chunks), select_columns[0], select_columns[1],
+                                      column_ids = column_ids, row_ids = row_ids, column_key = column_key, row_key = row_key, sparse = sparse)
+        #includes the lookups of arrays_to_numpy, which are also profiled on their own
+        self.profile_materialise(key, start, sum(len(v) for v in value_chunks))
+
+        return output
+
+
+    def arrays_to_numpy(self, row_idents, column_idents, values, row_identifer, column_identifer, column_ids = 'all', row_ids = 'all', column_key = None, row_key = None, sparse = False):
+
+        '''
+        Builds the row_lookup, column_lookup, X of to_numpy from arrays of row identifiers, column identifiers and values,
+        so matrices that are not read from a query (e.g. the feature store of MPRA_DB) are numbered the same way.
+        '''
+
+        column_num = self.get_max(column_identifer) + 1 if column_ids == 'all' else len(column_ids)
         row_num = self.get_max(row_identifer) + 1 if row_ids == 'all' else len(row_ids)
 
-        
-    
-        X = np.zeros([row_num, column_num])
+        X = np.zeros([row_num, column_num]) if not sparse else scipy.sparse.csr_matrix((row_num, column_num))
+
+        if len(values) == 0:
+            return {}, {}, X
 
-        new_row_num = 0
-        row_lookup = {}
-        new_col_num = 0
-        column_lookup = {}
         column_key_lookup = self[column_identifer,column_key].to_dict() if column_key is not None else None
         row_key_lookup = self[row_identifer,row_key].to_dict() if row_key is not None else None
 
-        for ridx, cidx, value in self.execute(sql_str = sql_str, number_to_fetch = 'all'):
-            if row_ids != 'all':
-                ridx = ridx if row_key is None else row_key_lookup[ridx]
-                if ridx not in row_lookup:
-                    row_lookup[ridx] = new_row_num
-                    new_row_num += 1
-                ridx = row_lookup[ridx]
+        ridx, row_lookup = self.index_ids(row_idents, row_ids, row_key_lookup)
+        cidx, column_lookup = self.index_ids(column_idents, column_ids, column_key_lookup)
+
+        if sparse:
+            X = scipy.sparse.csr_matrix((values, (ridx, cidx)), shape = X.shape)
+            X.eliminate_zeros()
+        else:
+            X[ridx,cidx] = values
 
-            elif row_key is not None:
-                row_lookup = row_key_lookup
-     
-            
-            if column_ids != 'all':
-                cidx = cidx if column_key is None else column_key_lookup[cidx]
-                if cidx not in column_lookup:
-                    column_lookup[cidx] = new_col_num
-                    new_col_num += 1
-                cidx = column_lookup[cidx] 
-
-            elif column_key is not None:
-                column_lookup = column_key_lookup
-            X[ridx,cidx] = value
-            
-            
         return row_lookup,column_lookup, X
+
+
+    def index_ids(self, ids, id_list, key_lookup):
+
+        '''
+        Maps the identifiers of to_numpy to matrix indexes. Returns the indexes and the lookup to_numpy returns.
+        '''
+
+        if isinstance(id_list, str) and id_list == 'all':
+            return ids, {} if key_lookup is None else key_lookup
+
+        unique_ids, first_idx, inverse = np.unique(ids, return_index = True, return_inverse = True)
+        order = np.argsort(first_idx)
+        positions = np.empty(len(unique_ids), dtype = np.int64)
+        lookup = {}
+
+        for i, u in zip(order.tolist(), unique_ids[order].tolist()):
+            k = u if key_lookup is None else key_lookup[u]
+            if k not in lookup:
+                lookup[k] = len(lookup)
+            positions[i] = lookup[k]
+
+        return positions[inverse.ravel()], lookup
     
     
 
     
     def to_df(self):
         
-        sql_str, select_columns = self.execute_selection()
-        df = pd.DataFrame(self.execute(sql_str = sql_str, number_to_fetch='all'), columns = select_columns)
+        sql_str, select_columns, params = self.execute_selection()
+        q = self.execute(sql_str = sql_str, number_to_fetch='all', params = params)
+        key, start = self.profile_key, time.perf_counter()
+        df = pd.DataFrame(q, columns = select_columns)
+        self.profile_materialise(key, start)
+
         return df
 
 
-    def to_dict(self, group_by_key = False, key = None):
+    def fetch_batches(self, size):
+
+        '''
+        Runs the current selection on a cursor of its own, so other queries can run while the result is consumed.
+        Returns the selected columns and a generator of row lists of at most size rows.
+        '''
+
+        sql_str, select_columns, params = self.execute_selection()
+        logging.debug(f'{sql_str} {str(params)[:200]}' if len(params) > 0 else sql_str)
 
-        sql_str, select_columns = self.execute_selection()
+        cursor = self.conn.cursor()
+        start = time.perf_counter()
+        cursor.execute(sql_str, params)
+        key = None
+
+        if self.query_profile is not None:
+            self.profile_query(sql_str, params, time.perf_counter() - start, 0)
+            key = self.profile_key
+
+        def row_batches():
+            try:
+                while True:
+                    start = time.perf_counter()
+                    rows = cursor.fetchmany(size)
+                    self.profile_materialise(key, start, len(rows))
+                    if len(rows) == 0:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+
+        return select_columns, row_batches()
+
+
+    def iter_batches(self, size = 1 << 16):
+
+        '''
+        Streams the current selection as dictionaries of column name: np.array with at most size rows:
+
+        for batch in db.select(['reporter_id','kmer']).iter_batches(10000):
+            batch['kmer']
+        '''
+
+        select_columns, row_batches = self.fetch_batches(size)
+        return ({c: np.array(v) for c, v in zip(select_columns, zip(*rows))} for rows in row_batches)
+
+
+    def to_arrow_batches(self, size = 1 << 16):
+
+        '''
+        Streams the current selection as pyarrow.RecordBatch objects with at most size rows.
+        '''
+
+        if pyarrow is None:
+            raise Exception('pyarrow is required for to_arrow_batches, use iter_batches instead')
+
+        select_columns, row_batches = self.fetch_batches(size)
+        return (pyarrow.RecordBatch.from_arrays([pyarrow.array(v) for v in zip(*rows)], names = select_columns) for rows in row_batches)
+
+
+    def to_dict(self, group_by_key = False, key = None, group_in_sql = False):
+
+        '''
+        Returns {key: value} for a db.select(columns = [key, value]) query, or {key: [values]} with group_by_key. With group_in_sql
+        the values are grouped by SQLite (GROUP BY key and json_group_array), so one row per key is transferred instead of one per value.
+        '''
+
+        if group_by_key and group_in_sql:
+            return self.group_to_dict(key)
+
+        sql_str, select_columns, params = self.execute_selection()
 
         if len(select_columns) != 2 and key is None:
             raise Exception('Please structure query so as follows: db.select(columns = [key,value]) or provide key')
@@ -625,7 +1295,8 @@ class DB_SQLite(Select_to_SQL):
         else:
             key_idx = [0]
 
-        q = self.execute(sql_str = sql_str, number_to_fetch='all')
+        q = self.execute(sql_str = sql_str, number_to_fetch='all', params = params)
+        profile_key, start = self.profile_key, time.perf_counter()
         output_dic = {}
 
         for x in q:
@@ -642,8 +1313,50 @@ class DB_SQLite(Select_to_SQL):
                 else:
                     raise Exception('There is duplicate keys in query. Resolve or set group_by_key = True')
 
+        self.profile_materialise(profile_key, start)
+
         return output_dic
-        
+
+
+    def json_value(self, column):
+
+        #json renders reals with 15 significant digits, printf('%!.17g') keeps them exact and infinities are written as 1e999
+        return (f"CASE WHEN typeof({column}) != 'real' THEN {column} WHEN abs({column}) <= 1.7976931348623157e308 THEN json(printf('%!.17g', {column})) "
+                f"WHEN {column} > 0 THEN json('1e999') ELSE json('-1e999') END")
+
+
+    def group_to_dict(self, key = None):
+
+        '''
+        to_dict(group_by_key = True, group_in_sql = True): rewrites the selection to SELECT key, json_group_array(value) ... GROUP BY key.
+        '''
+
+        if self.columns_to_group is not None:
+            raise Exception('group_in_sql groups by the key, remove the groupby statement')
+
+        columns = list(self.select_columns)
+
+        if len(columns) != 2 and key is None:
+            raise Exception('Please structure query so as follows: db.select(columns = [key,value]) or provide key')
+
+        key = [columns[0]] if key is None else [key] if type(key) == str else key
+        key_columns = [c for c in columns if c in key]
+        values = [self.json_value(c) for c in columns if c not in key]
+        value_str = values[0] if len(values) == 1 else f'json_array({", ".join(values)})'
+
+        #SELECT DISTINCT drops duplicate key, value rows before they are grouped
+        self.select_columns = key_columns + [f'json_group_array({"DISTINCT " if self.distinct else ""}{value_str})']
+        self.distinct = False
+        self.groupby(key_columns)
+
+        sql_str, select_columns, params = self.execute_selection()
+        q = self.execute(sql_str = sql_str, number_to_fetch = 'all', params = params)
+        profile_key, start = self.profile_key, time.perf_counter()
+        output_dic = {k[0] if len(k) == 1 else tuple(k): json.loads(v) for *k, v in q}
+        self.profile_materialise(profile_key, start)
+
+        return output_dic
+
     def generate_output(self, output, columns, output_type = 'raw'):
 
         match output_type:
@@ -658,38 +1371,192 @@ class DB_SQLite(Select_to_SQL):
 
     def insert(self, table_name, columns, values, single = False, primary_key = None, foreign_keys = None, add_table = False):
 
+        '''
+        Inserts values into table_name in one transaction, or in the transaction of the load inside bulk_load. values can be a list
+        or any iterable of rows (e.g. a generator), rows are streamed to executemany. With add_table the column types of a new table are taken from the first row.
+        '''
+
         if table_name not in self.tables:
             if add_table:
-                self.new_table(table_name, columns, [type(v) for v in values[0]], primary_key, foreign_keys)
+                if single:
+                    first_row = values
+                else:
+                    values = iter(values)
+                    first_row = next(values, None)
+                    if first_row is None:
+                        raise Exception(f'No values to create {table_name}!')
+                    values = itertools.chain([first_row], values)
+
+                self.new_table(table_name, columns, [type(v) for v in first_row], primary_key, foreign_keys)
             else:
                 raise Exception(f'{table_name} not in DB!')
 
         value_str = ', '.join(['?' for n in range(len(columns))])
         column_str = ', '.join(columns)
 
+        #values can be a generator that queries table_name while it is written
+        self.check_changes()
+        self.invalidate(table_name)
+
         try:
             if single:
                 self.cursor.execute(f'INSERT INTO {table_name} ({column_str}) VALUES({value_str})', values)
         
             else:
-                self.cursor.execute('BEGIN TRANSACTION;')
+                if not self.bulk_loading:
+                    self.cursor.execute('BEGIN TRANSACTION;')
                 self.cursor.executemany(f'INSERT INTO {table_name} ({column_str}) VALUES({value_str})', values)
-                
-            self.cursor.execute('COMMIT;')
+
+            #bulk_load commits or rolls back the whole load
+            if not self.bulk_loading:
+                self.cursor.execute('COMMIT;')
 
         except sqlite3.Error as e:
-            if not single:
+            if not single and not self.bulk_loading:
                 self.cursor.execute('ROLLBACK;')
                 logging.critical(f'Exception: {" ".join(e.args)}')
             raise Exception(f' Exception: {" ".join(e.args)}')
 
+        finally:
+            self.invalidate(table_name)
+            self.cache_changes = self.conn.total_changes
+
+
+    @contextlib.contextmanager
+    def bulk_load(self, cache_size_mb = 1024):
+
+        '''
+        Context manager for database builds:
+
+        with db.bulk_load():
+            db.insert(...)
+
+        Switches to WAL journaling, synchronous = OFF and a cache of cache_size_mb, drops the user created indexes for the
+        duration of the load and recreates them afterwards together with the missing index_specs, then restores the
+        previous journal mode, synchronous and cache settings. Nested calls run inside the outer load. The load is one transaction,
+        insert does not commit while bulk_loading is set: if the body raises everything written by the load is rolled back and only
+        the dropped indexes and the settings are restored.
+        '''
+
+        if self.bulk_loading:
+            yield self
+            return
+
+        if self.conn.in_transaction:
+            self.conn.commit()
+
+        settings = {p: self.execute(f'PRAGMA {p}', 1) for p in ['journal_mode', 'synchronous', 'cache_size']}
+        indexes = self.execute('SELECT name, tbl_name, sql FROM sqlite_master WHERE type = "index" AND sql IS NOT NULL', 'all')
+
+        for name, _, _ in indexes:
+            self.cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+        self.invalidate('sqlite_master')
+
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        self.cursor.execute('PRAGMA synchronous = OFF')
+        self.cursor.execute(f'PRAGMA cache_size = {-cache_size_mb * 1024}')
+        self.bulk_loading = True
+        self.cursor.execute('BEGIN TRANSACTION;')
+        logging.info(f'Bulk load started, {len(indexes)} indexes dropped, previous settings: {settings}')
+
+        loaded = False
+
+        try:
+            yield self
+
+        except BaseException:
+            #a failed load is rolled back as a whole rather than committed half way
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            self.query_cache.clear()
+            raise
+
+        else:
+            if self.conn.in_transaction:
+                self.conn.commit()
+            loaded = True
+
+        finally:
+            self.bulk_loading = False
+            tables = self.tables
+            existing = set(i[0] for i in self.execute('SELECT name FROM sqlite_master WHERE type = "index"', 'all'))
+
+            for name, table_name, sql in indexes:
+                if table_name in tables and name not in existing:
+                    self.cursor.execute(sql)
+
+            self.invalidate('sqlite_master')
+            if loaded:
+                self.create_indexes()
+            self.cursor.execute(f'PRAGMA journal_mode = {settings["journal_mode"]}')
+            self.cursor.execute(f'PRAGMA synchronous = {settings["synchronous"]}')
+            self.cursor.execute(f'PRAGMA cache_size = {settings["cache_size"]}')
+            logging.info(f'Bulk load finished, {len(indexes)} indexes recreated')
+
+
+    def create_indexes(self, analyze = True):
+
+        '''
+        Creates the indexes in index_specs whose table exists and which are not in the database yet. With analyze the
+        tables that got a new index are analyzed so the query planner has statistics to choose between indexes.
+        Returns the names of the indexes created.
+        '''
+
+        tables = self.tables
+        existing = set(i[0] for i in self.execute('SELECT name FROM sqlite_master WHERE type = "index"', 'all'))
+        created = []
+
+        for name, (table_name, columns) in self.index_specs.items():
+            if table_name not in tables or name in existing:
+                continue
+
+            missing = [c for c in columns if c not in self.table_columns[table_name]]
+            if len(missing) > 0:
+                raise Exception(f'Index {name}: columns {missing} not found in table {table_name}!')
+
+            self.cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table_name} ({", ".join(columns)})')
+            created.append(name)
+
+        if analyze:
+            for table_name in sorted(set(self.index_specs[name][0] for name in created)):
+                self.cursor.execute(f'ANALYZE {table_name}')
+
+        if self.conn.in_transaction:
+            self.conn.commit()
+
+        self.invalidate('sqlite_master')
+        logging.info(f'Created indexes: {created}')
+        return created
+
+
+    def explain(self, sql_str = None, params = ()):
+
+        '''
+        Returns the EXPLAIN QUERY PLAN of sql_str, or of the current selection if sql_str is None, as a dictionary with
+        the plan lines, the named indexes the plan uses and the tables it scans without an index:
+
+        db.select(['reporter_id']).where(db['reporter_group_id'] == 1).explain()
+        '''
+
+        if sql_str is None:
+            sql_str, _, params = self.execute_selection()
+
+        plan = [r[3] for r in self.execute(f'EXPLAIN QUERY PLAN {sql_str}', 'all', params)]
+        indexes = [i for p in plan for i in re.findall(r'USING (?:\w+ )*INDEX (\w+)', p)]
+        scans = [p.split()[1] for p in plan if p.startswith('SCAN ') and 'INDEX' not in p]
+
+        return {'sql': sql_str, 'params': params, 'plan': plan, 'indexes': indexes, 'scans': scans}
+
 
     def drop_table(self, table_name):
         
         self.check_table(table_name)
         self.execute(f'DROP TABLE {table_name}')
+        self.invalidate([table_name, 'sqlite_master'])
         self.get_foriegn_keys()
         self.build_column_lookups()
+        self.build_join_paths()
 
     def check_table(self, table_name):
         if table_name not in self.tables:
@@ -762,7 +1629,11 @@ class DB_SQLite(Select_to_SQL):
             
     def get_tables(self, columns):
 
-        tmp_tables = {}
+        '''
+        Returns the tables and joins needed to select columns. Plans are memoised on the column names in query order
+        (the order decides the FROM table) and cleared by build_join_paths when tables are added or dropped.
+        '''
+
         col = []
 
         for c in columns:
@@ -770,6 +1641,21 @@ class DB_SQLite(Select_to_SQL):
             c = c[1] if len(c) == 3 else c[0]
             col.append(c)
 
+        col = tuple(col)
+
+        if col not in self.join_plans:
+            self.join_plans[col] = self.plan_joins(col)
+
+        tables, join_str = self.join_plans[col]
+
+        return list(tables), None if join_str is None else list(join_str)
+
+
+    def plan_joins(self, col):
+
+        tmp_tables = {}
+
+        for c in col:
             try: 
                 columns_tables = self.column_lookup[c]
 
@@ -786,7 +1672,7 @@ class DB_SQLite(Select_to_SQL):
         tables_remaining = len(tables)
 
         if len(tables) == 1:
-            return list(tables), None
+            return tuple(tables), None
             
         join_str = []
         tables_added = [tables[0]]
@@ -824,36 +1710,54 @@ class DB_SQLite(Select_to_SQL):
                 break
             
         if tables_remaining != 0:
-            print(tables, columns, tables_added)
+            print(tables, col, tables_added)
             self.reset_query()
             raise Exception('Selection is not possible!')
         
-        return tables_added, join_str
+        return tuple(tables_added), tuple(join_str)
 
 
-    def find_path(self, t1,t2, prev_tables = None, rlev = 0):
-    
-        if prev_tables == None:
-            prev_tables = [t1]
+    def find_path(self, t1, t2):
+        path = self.join_paths.get(tuple([t1, t2]))
+        return None if path is None else list(path)
 
-        try:
-            tmp_paths = self.table_conn[t1]
-        except:
-            return None
 
-        if t2 in tmp_paths:
-            return self.get_join(t1,t2)
+    def build_join_paths(self):
 
-        for p in tmp_paths:
-            if p in prev_tables:
-                continue
+        '''
+        Breadth first search from every table over table_conn, stores the joins of the shortest path between each
+        pair of connected tables in join_paths and clears the memoised join plans. Ties between routes of the same
+        length go to the route whose tables come first in table_conn, so the route of a pair is fixed by the schema.
+
+        This is not the route the former recursive search took for tables connected by several routes: that search
+        returned the first route found depth first (and depended on the recursion limit), the shortest route can join
+        through other tables. E.g. run_id with data_group_id now joins through run_to_data_iso and data_attribute
+        instead of replicate_attribute, sample_attribute and data_group_attribute_iso, which selects the data groups
+        of the run's own data rather than every data group of the run's sample.
+        '''
 
-            try:
-                return self.get_join(t1,p) + self.find_path(p,t2, prev_tables, rlev+1)   
-            except:
-                continue
-        rlev -= 1
-        return None           
+        self.join_paths = {}
+        self.join_plans = {}
+
+        for t1 in self.table_conn:
+            previous = {t1: None}
+            queue = collections.deque([t1])
+
+            while len(queue) > 0:
+                t = queue.popleft()
+                for t2 in self.table_conn[t]:
+                    if t2 not in previous:
+                        previous[t2] = t
+                        queue.append(t2)
+
+            for t2 in previous:
+                if t2 == t1:
+                    continue
+                path = [t2]
+                while previous[path[-1]] is not None:
+                    path.append(previous[path[-1]])
+                path = path[::-1]
+                self.join_paths[tuple([t1, t2])] = tuple(j for n in range(len(path) - 1) for j in self.get_join(path[n], path[n + 1]))
 
 
     def find_paths(self,t1, t2, connected_tables = None):
@@ -1062,5 +1966,5 @@ class DB_SQLite(Select_to_SQL):
 
     @property
     def sql_str(self):
-        sql_str, select_columns = self.execute_selection(reset_query = False)
+        sql_str, select_columns, params = self.execute_selection(reset_query = False)
         return sql_str
\ No newline at end of file
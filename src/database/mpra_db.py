@@ -1,14 +1,42 @@
+import os
+import re
 import json
+import array
+import collections
 import scipy.sparse
 import numpy as np
 import toml
+import logging
 import sqlite3
 
 from src.database import selector,db_to_sqlite
 
 
 class MPRA_DB(db_to_sqlite.DB_SQLite):
-    
+
+    #doc/db_schema.sql only declares primary keys, these cover the id lookups and joins of the selectors and loaders
+    index_specs = {
+        'reporter_id_idx': ('reporter', ['reporter_id', 'tags']),
+        'feature_value_idx': ('feature', ['feature_id', 'reporter_id', 'feature_value']),
+        'feature_reporter_idx': ('feature', ['reporter_id']),
+        'feature_attribute_id_idx': ('feature_attribute', ['feature_id', 'feature_type']),
+        'sample_attribute_id_idx': ('sample_attribute', ['sample_id']),
+        'data_attribute_id_idx': ('data_attribute', ['data_id']),
+        'data_group_attribute_id_idx': ('data_group_attribute_iso', ['data_group_id']),
+        'data_group_to_data_data_idx': ('data_group_to_data_iso', ['data_id']),
+        'run_attribute_replicate_idx': ('run_attribute', ['replicate_id']),
+        'run_to_data_data_idx': ('run_to_data_iso', ['data_id']),
+        'raw_data_value_idx': ('raw_data_iso', ['run_id', 'reporter_id', 'raw_count', 'rpm', 'normalized_count']),
+        'processed_data_value_idx': ('processed_data_iso', ['data_id', 'reporter_id', 'processed_data_value']),
+        'sample_data_value_idx': ('sample_data_iso', ['data_group_id', 'reporter_id', 'data_value']),
+        'reporter_group_id_idx': ('reporter_group_attribute', ['reporter_group_id']),
+        'reporter_group_reporter_idx': ('reporter_group_to_reporter_iso', ['reporter_group_id', 'reporter_id']),
+        'reporter_group_data_group_idx': ('reporter_group_to_data_group_iso', ['reporter_group_id', 'data_group_id']),
+    }
+
+    #per feature_type csc blocks of the features under output_path, see write_feature_blocks
+    feature_store_dir = 'feature_store'
+
     def __init__(self, db_path, output_path, schema_path = None):
         super().__init__(db_path, schema_path)
         self.output_path = output_path
@@ -47,13 +75,232 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
 
 
     def load_features(self, feature_ids, sparse = False):
-        if feature_ids == 'all':
-            _, self.feature_idxs, self.features = self.select(columns = ['reporter_id','feature_id', 'feature_value']).to_numpy(column_key = 'feature_name')
+
+        '''
+        Loads the features from the memory-mapped feature store, which add_features keeps up to date. A missing or stale store
+        (e.g. a database built before the store, or features changed in sql) is rebuilt from the feature table first.
+        '''
+
+        stored = self.read_feature_store(feature_ids)
+
+        if stored is None and self.feature_store_identity['max_feature_rowid'] is not None:
+            self.build_feature_store()
+            stored = self.read_feature_store(feature_ids)
+
+        if stored is not None:
+            rids, fids, values = stored
+            _, self.feature_idxs, self.features = self.arrays_to_numpy(rids, fids, values, 'reporter_id', 'feature_id', column_ids = feature_ids, column_key = 'feature_name', sparse = sparse)
+        elif feature_ids == 'all':
+            _, self.feature_idxs, self.features = self.select(columns = ['reporter_id','feature_id', 'feature_value']).to_numpy(column_key = 'feature_name', sparse = sparse)
         else:
-            _, self.feature_idxs, self.features = self.select(columns = ['reporter_id','feature_id', 'feature_value']).where(self['feature_id'].in_(feature_ids)).to_numpy(column_ids = feature_ids, column_key = 'feature_name')
+            _, self.feature_idxs, self.features = self.select(columns = ['reporter_id','feature_id', 'feature_value']).where(self['feature_id'].in_(feature_ids)).to_numpy(column_ids = feature_ids, column_key = 'feature_name', sparse = sparse)
 
         self.feature_names = {v:k for k,v in self.feature_idxs.items()}
 
+
+    @property
+    def feature_store_path(self):
+        return os.path.join(self.output_path, self.feature_store_dir)
+
+
+    @property
+    def feature_store_manifest(self):
+
+        manifest_path = os.path.join(self.feature_store_path, 'manifest.json')
+
+        if not os.path.exists(manifest_path):
+            return None
+
+        return json.load(open(manifest_path, 'r'))
+
+
+    def clear_feature_store(self):
+
+        manifest = self.feature_store_manifest
+
+        if manifest is None:
+            return
+
+        os.remove(os.path.join(self.feature_store_path, 'manifest.json'))
+
+        for block in manifest['blocks'].values():
+            for a in ('data', 'indices', 'indptr'):
+                block_path = os.path.join(self.feature_store_path, f'{block["file"]}.{a}.npy')
+                if os.path.exists(block_path):
+                    os.remove(block_path)
+
+
+    def read_feature_block(self, block, mmap_mode = 'r'):
+
+        block_path = os.path.join(self.feature_store_path, block['file'])
+        data, indices, indptr = [np.load(f'{block_path}.{a}.npy', mmap_mode = mmap_mode) for a in ('data', 'indices', 'indptr')]
+
+        if len(data) != block['nnz'] or len(indptr) != block['shape'][1] + 1:
+            raise Exception(f'Feature store block {block["file"]} does not match {self.feature_store_path}/manifest.json. Please rebuild the store with build_feature_store.')
+
+        return scipy.sparse.csc_matrix((data, indices, indptr), shape = block['shape'])
+
+
+    def write_feature_block(self, block, X):
+
+        block_path = os.path.join(self.feature_store_path, block['file'])
+
+        for a in ('data', 'indices', 'indptr'):
+            with open(f'{block_path}.{a}.npy.tmp', 'wb') as f:
+                np.save(f, getattr(X, a))
+            os.replace(f'{block_path}.{a}.npy.tmp', f'{block_path}.{a}.npy')
+
+        block['shape'] = list(X.shape)
+        block['nnz'] = int(X.nnz)
+
+
+    @property
+    def feature_store_identity(self):
+
+        '''
+        Identifies the database and the state of its feature table, the store is only read if its manifest holds the same identity.
+        '''
+
+        db_path = os.path.realpath(self.db_path)
+
+        return {'db_path': db_path,
+                'inode': os.stat(db_path).st_ino,
+                'max_feature_rowid': self.execute('SELECT MAX(rowid) FROM feature', 'all')[0][0],
+                'max_reporter_id': self.execute('SELECT MAX(reporter_id) FROM reporter', 'all')[0][0]}
+
+
+    def write_feature_blocks(self, type_arrays, manifest):
+
+        '''
+        Writes or extends the blocks of the feature store from {feature_type: (feature_ids, reporter_ids, values)}. Each feature_type is a
+        reporter_id x feature csc matrix saved as .npy files, the columns are the sorted feature_ids of the type, which manifest.json keeps
+        with the shape of each block and the database identity. Only the blocks of the given feature_types are read and rewritten.
+        '''
+
+        os.makedirs(self.feature_store_path, exist_ok = True)
+
+        for ftype, (fids, rids, values) in type_arrays.items():
+            fids, rids, values = np.asarray(fids, dtype = np.int64), np.asarray(rids, dtype = np.int64), np.asarray(values, dtype = np.float64)
+            block = manifest['blocks'].get(ftype)
+
+            if block is not None:
+                X = self.read_feature_block(block, mmap_mode = None).tocoo()
+                block_fids = np.array(block['feature_ids'], dtype = np.int64)
+                fids, rids, values = np.concatenate([block_fids[X.col], fids]), np.concatenate([X.row.astype(np.int64), rids]), np.concatenate([X.data, values])
+                row_num = block['shape'][0]
+            else:
+                block_name = re.sub(r'[^\w.-]', '_', ftype)
+                block = {'file': f'{len(manifest["blocks"])}_{block_name}'}
+                row_num = 0
+
+            column_ids = np.unique(fids)
+            shape = (max(row_num, int(rids.max()) + 1 if len(rids) != 0 else 0), len(column_ids))
+
+            X = scipy.sparse.csc_matrix((values, (rids, np.searchsorted(column_ids, fids))), shape = shape)
+            X.sort_indices()
+
+            block['feature_ids'] = column_ids.tolist()
+            self.write_feature_block(block, X)
+            manifest['blocks'][ftype] = block
+
+        manifest['db'] = self.feature_store_identity
+        manifest_path = os.path.join(self.feature_store_path, 'manifest.json')
+        json.dump(manifest, open(f'{manifest_path}.tmp', 'w'))
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+    def build_feature_store(self):
+
+        '''
+        Rewrites the feature store from the feature table, e.g. for databases built before the store or after features were changed in sql.
+        The batches of the feature table are split by feature_type as they are read, so each block is built once from its own values.
+        '''
+
+        self.clear_feature_store()
+
+        type_lookup = dict(self.execute('SELECT feature_id, feature_type FROM feature_attribute', 'all'))
+
+        if len(type_lookup) == 0:
+            return
+
+        ftypes = sorted(set(type_lookup.values()))
+        type_idx = np.full(max(type_lookup) + 1, -1, dtype = np.int64)
+
+        for fid, ftype in type_lookup.items():
+            type_idx[fid] = ftypes.index(ftype)
+
+        chunks = [[] for ftype in ftypes]
+
+        for batch in self.select(['feature_id', 'reporter_id', 'feature_value']).iter_batches():
+            fids = batch['feature_id'].astype(np.int64)
+            batch_types = type_idx[fids]
+
+            for t in np.unique(batch_types[batch_types >= 0]).tolist():
+                in_type = batch_types == t
+                chunks[t].append((fids[in_type], batch['reporter_id'][in_type].astype(np.int64), batch['feature_value'][in_type].astype(np.float64)))
+
+        manifest = {'blocks': {}}
+
+        #one type at a time, so only the values of one block are concatenated
+        for t, ftype in enumerate(ftypes):
+            if len(chunks[t]) != 0:
+                self.write_feature_blocks({ftype: [np.concatenate(c) for c in zip(*chunks[t])]}, manifest)
+                chunks[t] = None
+
+
+    def read_feature_store(self, feature_ids = 'all'):
+
+        '''
+        Returns reporter_ids, feature_ids and values from the memory-mapped blocks of the feature store, ordered by feature_id like the feature table index.
+        Returns None if there is no store, it was written for another database or feature table state, or its blocks do not hold
+        the feature_ids of the feature_attribute catalogue.
+        '''
+
+        manifest = self.feature_store_manifest
+
+        if manifest is None:
+            return None
+
+        if manifest.get('db') != self.feature_store_identity:
+            logging.warning(f'{self.feature_store_path} was written for another database or an older feature table.')
+            return None
+
+        catalogue = collections.defaultdict(list)
+
+        for fid, ftype in self.execute('SELECT feature_id, feature_type FROM feature_attribute ORDER BY feature_id', 'all'):
+            catalogue[ftype].append(fid)
+
+        if catalogue != {ftype: block['feature_ids'] for ftype, block in manifest['blocks'].items()}:
+            logging.warning(f'{self.feature_store_path} does not match the feature_attribute table.')
+            return None
+
+        wanted = None if isinstance(feature_ids, str) and feature_ids == 'all' else np.asarray(list(feature_ids), dtype = np.int64)
+        rid_blocks, fid_blocks, value_blocks = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)], [np.zeros(0)]
+
+        for block in manifest['blocks'].values():
+            block_fids = np.array(block['feature_ids'], dtype = np.int64)
+            X = self.read_feature_block(block)
+
+            if wanted is not None:
+                columns = np.flatnonzero(np.isin(block_fids, wanted))
+                if len(columns) == 0:
+                    continue
+                X, block_fids = X[:,columns], block_fids[columns]
+
+            X = X.tocoo()
+            rid_blocks.append(X.row.astype(np.int64))
+            fid_blocks.append(block_fids[X.col])
+            value_blocks.append(X.data)
+
+        rids, fids, values = np.concatenate(rid_blocks), np.concatenate(fid_blocks), np.concatenate(value_blocks)
+
+        if wanted is not None:
+            order = np.argsort(fids, kind = 'stable')
+            rids, fids, values = rids[order], fids[order], values[order]
+
+        return rids, fids, values
+
+
     @property
     def selectors(self):
         return [getattr(self,s) for s in self.selector_names]
@@ -67,7 +314,7 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
     @property
     def max_sample_id(self):
 
-        max_sample_id = self.cursor.execute('Select MAX(sample_id) from mpra_sample').fetchall()[0][0]
+        max_sample_id = self.execute('Select MAX(sample_id) from mpra_sample', 'all')[0][0]
         max_sample_id = -1 if max_sample_id is None else max_sample_id
         return max_sample_id
 
@@ -75,7 +322,7 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
     @property
     def max_replicate_id(self):
         
-        max_replicate_id = self.cursor.execute('Select MAX(replicate_id) from mpra_replicate').fetchall()[0][0]
+        max_replicate_id = self.execute('Select MAX(replicate_id) from mpra_replicate', 'all')[0][0]
         max_replicate_id = -1 if max_replicate_id is None else max_replicate_id
         return max_replicate_id
 
@@ -100,30 +347,64 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
 
         '''
         This method adds features to the database. Feature names and types are stored in the feature_attr table, whereas the actual values of said feature are stored in the feature table.
+        The four sequences are zipped into rows for add_feature_rows.
         '''
 
-        #adding feature names and types to feature_attr table
+        self.add_feature_rows(zip(feature_names, reporter_ids, feature_types, feature_data))
+
+
+    def add_feature_rows(self, rows):
+
+        '''
+        Adds features from one iterable of (feature_name, reporter_id, feature_type, feature_value) rows, e.g. a generator, which is consumed once:
+        feature values are streamed into the feature table and new feature names get the next feature_id as they appear, their feature_attr rows are inserted afterwards.
+        Feature names already in the feature_attr table keep their feature_id, so the values of a feature can be added over several calls.
+        The values are also collected per feature_type while they stream and the store blocks of those types are written or extended
+        (see write_feature_blocks). A store that does not match the database beforehand is cleared instead, load_features rebuilds it.
+        '''
 
         max_feature_id = self.max_feature_id
-        fid_lookup = {}
-        fdata = []
-    
+        fid_lookup = dict(self.execute('SELECT feature_name, feature_id FROM feature_attribute', 'all'))
+        type_lookup = dict(self.execute('SELECT feature_name, feature_type FROM feature_attribute', 'all'))
         new_features = []
 
-        for fname, ftype, rid, fval in zip(feature_names, feature_types, reporter_ids, feature_data):
-            if fname not in fid_lookup:
-                max_feature_id += 1
-                fid_lookup[fname] = max_feature_id
-                new_features.append([max_feature_id, fname, ftype])
-            
-            fid = fid_lookup[fname]
-            fdata.append([fid, rid, fval])
-
+        identity = self.feature_store_identity
+        manifest = self.feature_store_manifest
+
+        if identity['max_feature_rowid'] is None:
+            #a store left in output_path by an earlier database is replaced
+            self.clear_feature_store()
+            manifest = {'blocks': {}}
+        elif manifest is not None and manifest.get('db') != identity:
+            manifest = None
+
+        type_arrays = collections.defaultdict(lambda: (array.array('q'), array.array('q'), array.array('d')))
+
+        def fdata():
+            nonlocal max_feature_id
+            for fname, rid, ftype, fval in rows:
+                if fname not in fid_lookup:
+                    max_feature_id += 1
+                    fid_lookup[fname] = max_feature_id
+                    type_lookup[fname] = ftype
+                    new_features.append([max_feature_id, fname, ftype])
+                fid = fid_lookup[fname]
+                if manifest is not None:
+                    fids, rids, values = type_arrays[type_lookup[fname]]
+                    fids.append(fid)
+                    rids.append(rid)
+                    values.append(float('nan') if fval is None else fval)
+                yield fid, rid, fval
+
+        #adding feature values to feature table, then the new names and types to feature_attr table
+
+        self.insert('feature', ['feature_id', 'reporter_id', 'feature_value'], fdata())
         self.insert('feature_attribute', ['feature_id', 'feature_name', 'feature_type'], new_features)
 
-        #adding feature values to feature table
-
-        self.insert('feature', ['feature_id', 'reporter_id', 'feature_value'], fdata)
+        if manifest is not None:
+            self.write_feature_blocks(type_arrays, manifest)
+        else:
+            self.clear_feature_store()
 
 
     #sql_result should be orded (row, col, data)
@@ -238,17 +519,21 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
             raise Exception('Please provide a read_filter for each sample_id.')
 
 
-        self.cursor.execute('BEGIN TRANSACTION;')
+        if not self.bulk_loading:
+            self.cursor.execute('BEGIN TRANSACTION;')
 
         try:
 
             for sid, minread in zip(sample_ids, minumum_reads):
                 self.cursor.execute(f'UPDATE samples set read_filter = {minread} WHERE sample_id = "{sid}"')
-                                  
-            self.cursor.execute('COMMIT')
+
+            if not self.bulk_loading:
+                self.cursor.execute('COMMIT')
+            self.invalidate('samples')
 
         except sqlite3.Error as e:
-            self.cursor.execute('ROLLBACK')
+            if not self.bulk_loading:
+                self.cursor.execute('ROLLBACK')
             raise Exception(f' Exception: {" ".join(e.args)}')
             
         
@@ -325,7 +610,7 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
 
     @property
     def max_feature_id(self):
-        feature_num = self.cursor.execute('SELECT max(feature_id) FROM feature_attribute').fetchall()
+        feature_num = self.execute('SELECT max(feature_id) FROM feature_attribute', 'all')
         if feature_num[0][0] is None:
             return -1
         else:
@@ -337,7 +622,7 @@ class MPRA_DB(db_to_sqlite.DB_SQLite):
         if 'kozak' not in self.tables:
             raise Exception('Kozak frequency matrices not found. Run kozaks.add_kozak_scores first')
         else:
-            kozak_dic = self.cursor.execute('SELECT kozak_id, frequency_matrix FROM kozak').fetchall()
+            kozak_dic = self.execute('SELECT kozak_id, frequency_matrix FROM kozak', 'all')
             return {k: json.loads(v) for k,v in kozak_dic}
 
 
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 
 class Selector:
 
@@ -23,8 +24,9 @@ class Selector:
         for run_type, raw_data_type, rf in self.read_filters:
             run_ids = set(db.select(['run_id']).where((db['run_type'] == run_type) & (db['data_group_id'].in_(self.data_group_ids))).to_list())
             num_run_ids = len(run_ids)
-            reporter_lookup = db.select(['reporter_id', 'replicate_id']).where((db['run_id'].in_(run_ids)) & (db[raw_data_type] >= float(rf)) & (db['tags'].like('%spikein%',exclude = True))).to_dict(group_by_key = True)
-            reporter_ids_list.append(set([r for r,d in reporter_lookup.items() if len(d) == num_run_ids]))  
+            #reporters passing the read filter in every run
+            reporter_ids = db.select(['reporter_id']).where((db['run_id'].in_(run_ids)) & (db[raw_data_type] >= float(rf)) & (db['tags'].like('%spikein%',exclude = True))).groupby(['reporter_id']).having(db['run_id'].count(distinct = True) == num_run_ids).fetchall()
+            reporter_ids_list.append(set([r[0] for r in reporter_ids]))
             self.read_filter_data_ids.append(tuple([run_type, tuple(run_ids)]))
             filters_added += 1
         
@@ -109,7 +111,12 @@ class Selector:
         elif len(didx) == 0:
             return self.db.features[ridx,:][:,fidx]
         else:
-            return np.hstack([self.db.data[ridx,didx],self.db.features[ridx,didx]])
+            data = self.db.data[ridx,:][:,didx]
+            features = self.db.features[ridx,:][:,fidx]
+            if scipy.sparse.issparse(features):
+                return scipy.sparse.hstack([scipy.sparse.csr_matrix(data), features], format = 'csr')
+            else:
+                return np.hstack([data, features])
 
 
                         
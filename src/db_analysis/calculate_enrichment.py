@@ -1,3 +1,4 @@
+import numpy as np
 import scipy.stats
 
 def calculate_enrichment(fcount, parent_ids, group_rids):
@@ -5,8 +6,9 @@ def calculate_enrichment(fcount, parent_ids, group_rids):
     pval_list = []
     total_counts = fcount[parent_ids,:].sum()
     total_group_counts = fcount[group_rids, :].sum()
-    group_fcount = fcount[group_rids, :].sum(axis = 0)
-    all_fcount = fcount[parent_ids,:].sum(axis = 0)
+    #np.asarray flattens the 1 x n matrix sparse sums return
+    group_fcount = np.asarray(fcount[group_rids, :].sum(axis = 0)).ravel()
+    all_fcount = np.asarray(fcount[parent_ids,:].sum(axis = 0)).ravel()
 
     for gc,ac in zip(group_fcount, all_fcount): 
         pval = scipy.stats.hypergeom.sf(gc - 1, total_counts , ac, total_group_counts) if ac != 0 else -1
@@ -17,7 +19,28 @@ def calculate_enrichment(fcount, parent_ids, group_rids):
     return pval_list
 
 
-def get_feature_enrichment(db, reporter_group_ids_added, feature_type):
+def get_group_reporter_ids(db, reporter_group_ids, pool = None):
+
+    '''
+    Returns {reporter_group_id: (reporter_ids, parent reporter_ids)}. The queries run on db's own connection, or concurrently on
+    pool (a db.read_pool() kept open by the caller) when there are many reporter groups to look up.
+    '''
+
+    if pool is None:
+        parent_ids = [db.select(['reporter_group_parent_id']).where(db['reporter_group_id'] == rgid).fetchone() for rgid in reporter_group_ids]
+        all_ids = list(dict.fromkeys(list(reporter_group_ids) + parent_ids))
+        rids = [db.select(['reporter_id']).where(db['reporter_group_id'] == rgid).to_list() for rgid in all_ids]
+    else:
+        parent_ids = pool.map([db.select(['reporter_group_parent_id']).where(db['reporter_group_id'] == rgid).to_query() for rgid in reporter_group_ids], number_to_fetch = 1)
+        all_ids = list(dict.fromkeys(list(reporter_group_ids) + parent_ids))
+        rids = pool.map([db.select(['reporter_id']).where(db['reporter_group_id'] == rgid).to_query() for rgid in all_ids], flatten = True)
+
+    rid_lookup = dict(zip(all_ids, rids))
+
+    return {rgid: (rid_lookup[rgid], rid_lookup[pid]) for rgid, pid in zip(reporter_group_ids, parent_ids)}
+
+
+def get_feature_enrichment(db, reporter_group_ids_added, feature_type, group_reporter_ids = None):
 
     feature_enrich_ids = ['reporter_group_id', 'feature_id', 'enrichment_pvalue','enrichment_fold_change']
     feature_enrich_foriegn_keys = [('reporter_group_id','reporter_group_attribute','reporter_group_id'), ('feature_id','feature_attribute','feature_id')]
@@ -27,25 +50,27 @@ def get_feature_enrichment(db, reporter_group_ids_added, feature_type):
         db.new_table('feature_enrichment_iso', feature_enrich_ids, feature_enrich_dtype, primary_key = 'reporter_group_id,feature_id', foreign_keys = feature_enrich_foriegn_keys)
     
     feature_ids = db.select(['feature_id']).where(db['feature_type'].like(f'%{feature_type}%')).to_list()
-    _, feature_id_lookup, fcount = db.select(['reporter_id','feature_id','feature_value']).where(db['feature_type'].like(f'%{feature_type}%')).to_numpy(column_ids = feature_ids)
+    _, feature_id_lookup, fcount = db.select(['reporter_id','feature_id','feature_value']).where(db['feature_type'].like(f'%{feature_type}%')).to_numpy(column_ids = feature_ids, sparse = True)
     feature_id_lookup = {v:k for k,v in feature_id_lookup.items()}
 
+    if group_reporter_ids is None:
+        group_reporter_ids = get_group_reporter_ids(db, reporter_group_ids_added)
+
     fenrich = []
 
     for rgid in reporter_group_ids_added:
-        parent_id = db.select(['reporter_group_parent_id']).where(db['reporter_group_id'] == rgid).fetchone()
-        gids = db.select(['reporter_id']).where(db['reporter_group_id'] == rgid).to_list()
-        pids = db.select(['reporter_id']).where(db['reporter_group_id'] == parent_id).to_list()
+        gids, pids = group_reporter_ids[rgid]
        
         pval_list = calculate_enrichment(fcount = fcount, parent_ids = pids, group_rids = gids)
         for n,p in enumerate(pval_list):
             fenrich.append([rgid, feature_id_lookup[n], *p])
-    c  = [tuple(f[:2]) for f in fenrich]
     
     db.insert(table_name = 'feature_enrichment_iso', columns = feature_enrich_ids, values = fenrich)
 
 
-def get_kmer_enrichment(db,reporter_group_ids_added, kmin, kmax):
+def get_kmer_enrichment(db,reporter_group_ids_added, kmin, kmax, pool = None):
+
+    group_reporter_ids = get_group_reporter_ids(db, reporter_group_ids_added, pool = pool)
 
     for n in range(kmin,kmax + 1):
-        get_feature_enrichment(db = db, reporter_group_ids_added= reporter_group_ids_added, feature_type= f'count_{n}mer')
\ No newline at end of file
+        get_feature_enrichment(db = db, reporter_group_ids_added= reporter_group_ids_added, feature_type= f'count_{n}mer', group_reporter_ids = group_reporter_ids)
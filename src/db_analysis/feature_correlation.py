@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 import scipy.stats
 
 
@@ -7,9 +8,14 @@ def get_correlation(selector_id, features, feature_ids, data, data_group_ids):
 
     feature_correlation = []
 
+    #sparse features are densified one column at a time
+    if scipy.sparse.issparse(features):
+        features = features.tocsc()
+
     for n,fid in enumerate(feature_ids):
+         fcolumn = features[:,[n]].toarray().ravel() if scipy.sparse.issparse(features) else features[:,n]
          for i,dgid in enumerate(data_group_ids):
-            corr, pval = scipy.stats.spearmanr(features[:,n],data[:,i])
+            corr, pval = scipy.stats.spearmanr(fcolumn,data[:,i])
             corr = 0 if np.isnan(corr) else corr
             pval = 1 if np.isnan(pval) else pval
             feature_correlation.append([fid, selector_id, dgid, corr, pval])
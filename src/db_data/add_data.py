@@ -16,6 +16,43 @@ def get_columns(db, table_name, tmp_dic, tmp_name):
 
 
 
+def load_counts(fpath):
+
+    '''
+    Loads count_reads output as {run_name: (reporter_names, counts)}. npz files hold a shared reporter_names array
+    and a (run, reporter) counts matrix, json files the nested {run_name: {reporter_name: count}} dictionary.
+    '''
+
+    if fpath.endswith('.npz'):
+        with np.load(fpath) as f:
+            reporter_names = f['reporter_names']
+            counts = f['counts']
+            run_names = f['run_names'].tolist()
+
+        return {run_name: (reporter_names, counts[n]) for n, run_name in enumerate(run_names)}
+
+    data = json.load(open(fpath,'r'))
+
+    return {run_name: (np.array(list(rcount), dtype = str), np.array(list(rcount.values()), dtype = np.int64)) for run_name, rcount in data.items()}
+
+
+
+def lookup_reporter_ids(names, reporter_names, reporter_ids):
+
+    '''
+    Maps names onto reporter ids with a binary search of the sorted reporter_names, -1 if not in the database.
+    '''
+
+    if len(reporter_names) == 0:
+        return np.full(len(names), -1, dtype = np.int64)
+
+    idx = np.searchsorted(reporter_names, names).clip(max = len(reporter_names) - 1)
+    found = reporter_names[idx] == names
+
+    return np.where(found, reporter_ids[idx], -1)
+
+
+
 def add_sample_info(db, sample_info):
 
     replicates_to_add = []
@@ -96,7 +133,7 @@ def add_data(db, data_params, add_to_db = False):
 
         data = {} 
         for exp_name, p in data_params['count_paths'].items():
-            data = data | json.load(open(p,'r'))
+            data = data | load_counts(p)
 
 
         run_lookup = db.select(columns = ['run_name','run_id']).where(db['run_id'].in_(run_ids_added)).to_dict()
@@ -106,7 +143,13 @@ def add_data(db, data_params, add_to_db = False):
         max_reporter_id = db.get_max('reporter_id')
         
 
-        for run_name, rcount in data.items():
+        reporter_names = np.array(list(reporter_lookup), dtype = str)
+        reporter_ids = np.array(list(reporter_lookup.values()), dtype = np.int64)
+        sort_idx = np.argsort(reporter_names)
+        reporter_names = reporter_names[sort_idx]
+        reporter_ids = reporter_ids[sort_idx]
+
+        for run_name, (names, counts) in data.items():
             if run_name not in run_lookup:
                 continue
                 #warnings.warn(f'Run name: {run_name} not found in DB. Please supply annotation!')
@@ -118,15 +161,14 @@ def add_data(db, data_params, add_to_db = False):
             tmp_data = np.zeros([max_reporter_id+1, 3])
             run_id = run_lookup[run_name]
 
-            for reporter_name, count in rcount.items():
-                if reporter_name not in reporter_lookup:
-                    if ignore_not_found:
-                        continue
-                    else:    
-                        raise Exception(f'Reporter name: {reporter_name} not found in DB. Please check fasta!')
-                
-                rid = reporter_lookup[reporter_name]
-                tmp_data[rid,0] = count
+            rids = lookup_reporter_ids(names, reporter_names, reporter_ids)
+            found = rids >= 0
+            not_found = ~found & (counts > 0)
+
+            if not_found.any() and not ignore_not_found:
+                raise Exception(f'Reporter name: {names[not_found][0]} not found in DB. Please check fasta!')
+
+            tmp_data[rids[found],0] = counts[found]
             
             tmp_data[:,1] = tmp_data[:,0] / tmp_data[:,0].sum()
 
@@ -138,10 +180,8 @@ def add_data(db, data_params, add_to_db = False):
             else:
                 tmp_data[:,2] = tmp_data[:,1]
 
-            for n in range(max_reporter_id + 1):
-                rdata = tmp_data[n,:]
-                if rdata.sum() > 0:
-                    data_to_db.append([run_id, n, *rdata.tolist()])
+            rids = np.flatnonzero(tmp_data.sum(axis = 1) > 0)
+            data_to_db.extend([run_id, n, *rdata] for n, rdata in zip(rids.tolist(), tmp_data[rids].tolist()))
 
 
         if add_to_db:
@@ -1,5 +1,7 @@
 import itertools
 
+batch_size = 1 << 16
+
 class Unique_counter:
 
     def __init__(self, kmax, reporter_id):
@@ -39,11 +41,9 @@ class Unique_counter:
     
 
 
-#returns a list of tuples of the form (reporter_id, kmer, list)
-
-def batch_kmers(reporters, kmax = 8):
+#yields tuples of the form (reporter_id, position, kmer)
 
-    kmer_data = []
+def iter_kmers(reporters, kmax = 8):
 
     for reporter_id, seq in reporters:
         seqlen = len(seq)
@@ -54,17 +54,33 @@ def batch_kmers(reporters, kmax = 8):
             kmers = [seq[i:i+x] for x in range(1, km + 1)]
             ucounter.add_kmers(kmers)
 
-        kmer_data += ucounter.get_kmer_counts
+        yield from ucounter.get_kmer_counts
+
+
+#returns a list of tuples of the form (reporter_id, position, kmer)
+
+def batch_kmers(reporters, kmax = 8):
+    return ['reporter_id','position', 'kmer'], list(iter_kmers(reporters, kmax))
+
+
+def iter_reporters(db):
+
+    for batch in db.select(['reporter_id','insert_sequence']).where(db['tags'].like('reporter')).iter_batches(batch_size):
+        yield from zip(batch['reporter_id'].tolist(), batch['insert_sequence'].tolist())
 
-    kmer_ids = ucounter.kmer_ids
-    return kmer_ids, kmer_data
 
 def add_kmers(db, kmax = 6):
 
-    kmer_ids, kmers = batch_kmers(db.reporters, kmax)
-    kmer_dtype = list(map(type, kmers[0]))
-    db.new_table('kmer_position_', kmer_ids, kmer_dtype, foreign_keys = [('reporter_id', 'reporter', 'reporter_id')])
-    db.insert('kmer_position_', kmer_ids, kmers)
+    kmer_ids = ['reporter_id','position', 'kmer']
+    db.insert('kmer_position_', kmer_ids, iter_kmers(iter_reporters(db), kmax), add_table = True, foreign_keys = [('reporter_id', 'reporter', 'reporter_id')])
+
+
+#returns a generator of (feature_name, reporter_id, feature_type, count) rows for add_feature_rows, the query runs right away on a cursor of its own
+
+def iter_kmer_counts(db):
+
+    batches = db.select(['reporter_id', 'kmer']).groupby(['reporter_id','kmer'], aggregate_functions={'count' :['kmer']}).iter_batches(batch_size)
+    return ((f'{kmer}_count', rid, f'count_{len(kmer)}mer', count) for batch in batches for rid, kmer, count in zip(batch['reporter_id'].tolist(), batch['kmer'].tolist(), batch['count(kmer)'].tolist()))
 
 
 #we could cluster features into reporter string, but this is a bit more flexible
@@ -75,19 +91,6 @@ def to_db(db, params):
     kmin = params.get('kmin')     
 
     add_kmers(db, kmax)
-    
-    kmer_counts = db.select(['reporter_id', 'kmer']).groupby(['reporter_id','kmer'], aggregate_functions={'count' :['kmer']}).fetchall()
-    
-    feature_names = []
-    reporter_ids = []
-    feature_data = []
-    feature_types = []
-
-    for rid,kmer,count in kmer_counts:
-        feature_names.append(f'{kmer}_count')
-        reporter_ids.append(rid)
-        feature_data.append(count)
-        feature_types.append(f'count_{len(kmer)}mer')
-        
-    db.add_features(feature_names = feature_names, reporter_ids = reporter_ids, feature_data = feature_data, feature_types = feature_types)
 
+    #one call for all kmers, the count batches are streamed as single rows
+    db.add_feature_rows(iter_kmer_counts(db))
@@ -1,15 +1,132 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
 import datetime
 import glob
+import hashlib
 import multiprocessing
 import json
+import itertools
 import os
+import pickle
+import re
+import resource
 import subprocess
+import time
+import zlib
+
+import numpy as np
+
+import count_unique
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 file_path = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/'
 paired_end = False
+reader = 'text'
+decompression_threads = 1
+shard_num = 1
+block_size = 1 << 24
+memory_budget = None
+tmp_path = None
+cache_path = None
+reporter_index = None
+mate_buffer_size = 1 << 22
+#times every read of the per-read parsers as its own 'read' stage, two perf_counter calls per read
+profile_reads = False
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+SAM_RE = re.compile(rb'^[^\t\n#]*#([^\t\n]*)\t(\d+)\t([^\t\n]*)\t[^\t\n]*\t[^\t\n]*\t([^\t\n]*)\t[^\n]*?\tNM:i:(\d+)', re.M)
+
+
+class Stage_profile:
+
+    '''
+    Wall time per stage, reads, reads passing the filters and input bytes of one input file (or of the whole run in the main
+    process). Written to the _counts.profile.json sidecar. ru_maxrss cannot be reset, so the RSS reported is the peak of the
+    process so far (worker_peak_rss_mb): in a pool worker it covers every file the worker has counted, not this file alone.
+    '''
+
+    def __init__(self, name):
+
+        self.name = name
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.read_num = 0
+        self.passed_num = 0
+        self.bytes_read = os.path.getsize(name) if os.path.isfile(name) else 0
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name, exclude = ()):
+
+        '''
+        Times the enclosed block as stage name, minus the time added to the excluded stages inside the block.
+        '''
+
+        excluded = sum(self.stages.get(e, 0) for e in exclude)
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            nested = sum(self.stages.get(e, 0) for e in exclude) - excluded
+            self.add_time(name, time.perf_counter() - start - nested)
+
+    def timed(self, iterable, stage):
+
+        '''
+        Yields from iterable and adds the time spent producing each item (decompression, reading and parsing) to stage.
+        Meant for block iterators, per-read iterators are only timed with profile_reads.
+        '''
+
+        iterator = iter(iterable)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def to_dict(self):
+
+        wall_time = time.perf_counter() - self.start
+
+        return {'name': self.name, 'wall_time': wall_time, 'stages': self.stages, 'reads': self.read_num, 'passed': self.passed_num,
+                'bytes_read': self.bytes_read, 'reads_per_sec': self.read_num / max(wall_time, 1e-9),
+                'worker_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def merge_profiles(name, profiles):
+
+    stages = {}
+
+    for p in profiles:
+        for k, v in p['stages'].items():
+            stages[k] = stages.get(k, 0) + v
+
+    wall_time = sum(p['wall_time'] for p in profiles)
+    read_num = sum(p['reads'] for p in profiles)
+
+    return {'name': name, 'wall_time': wall_time, 'stages': stages, 'reads': read_num, 'passed': sum(p['passed'] for p in profiles),
+            'bytes_read': max([p['bytes_read'] for p in profiles], default = 0), 'reads_per_sec': read_num / max(wall_time, 1e-9),
+            'worker_peak_rss_mb': max([p['worker_peak_rss_mb'] for p in profiles], default = 0), 'shards': len(profiles)}
 
 
 class Aligned_Read:
@@ -43,19 +160,9 @@ class Aligned_Read:
 
     def read_cigar(self):
 
-        cigar_list = list(self.cigar_str)
-
-        i = 0
-
-        while len(cigar_list) > 0:
-            b = cigar_list[i]
-            if b in 'MIDNSHP=X':
-                if b == 'M':
-                    n = cigar_list[:i]
-                    self.matches += int(''.join(n))
-                cigar_list = cigar_list[i+1:]
-                i = 0
-            i += 1
+        for n, op in CIGAR_RE.findall(self.cigar_str):
+            if op == 'M':
+                self.matches += int(n)
 
 
     def add_tags(self, tags):
@@ -73,9 +180,36 @@ class Aligned_Read:
 
             setattr(self,k,v)
 
-    def read_passed(self):
+    def add_segment(self, segment):
 
-        if self.edit_distance <= self.NM or self.min_matches < self.matches:
+        '''
+        Populates only the fields used by the read filter from a pysam.AlignedSegment.
+        Unmapped segments carry no NM tag and therefore fail read_passed, as in the text path.
+        '''
+
+        read_id = segment.query_name.split('#')
+        self.read_id = read_id[0]
+        self.umi = read_id[1]
+        self.flags = segment.flag
+        self.reference_name = segment.reference_name
+        self.matches = 0
+
+        if segment.has_tag('NM'):
+            self.NM = segment.get_tag('NM')
+
+        if segment.cigartuples is not None:
+            for op, n in segment.cigartuples:
+                if op == 0:
+                    self.matches += n
+
+        self.read_full = True
+
+    def read_passed(self, edit_distance = None, min_matches = None):
+
+        edit_distance = self.edit_distance if edit_distance is None else edit_distance
+        min_matches = self.min_matches if min_matches is None else min_matches
+
+        if edit_distance <= self.NM or min_matches < self.matches:
             return False
         else:
             return True
@@ -101,11 +235,16 @@ class ReadPair:
         self.read_full = False
     
     def add_read(self, read):
+
+        if type(read) == str:
+            l = read
+            read = Aligned_Read()
+            read.add_read(l)
     
         if self.read1 == None:
-            self.read1 = Aligned_Read().add_read(read)
+            self.read1 = read
         elif self.read2 == None:
-            self.read2 = Aligned_Read().add_read(read)
+            self.read2 = read
             self.read_full = True
         else:
             raise Exception('Read pair already full')
@@ -140,11 +279,171 @@ class ReadPair:
 
 
 
-def read_accepted_hits(fpath):
+class Mate_buffer:
+
+    '''
+    Pairs mates by read id in any input order. Each read is reduced to (is mate 1, passed, reference_name, umi) and held
+    until its mate arrives; mate 1 (flag 0x40) is filtered with the ReadPair r1 thresholds and mate 2 with the r2 thresholds.
+    A pair passes if both mates pass and map to the same reference. When more than max_reads mates are waiting they are
+    spilled to bucket files in spill_dir partitioned by read id, and the spilled mates are paired bucket by bucket in flush().
+    Secondary and supplementary alignments are skipped.
+    '''
+
+    bucket_num = 64
+
+    def __init__(self, max_reads = None, spill_dir = None):
+
+        self.max_reads = mate_buffer_size if max_reads is None else max_reads
+        self.spill_dir = spill_dir
+        self.buffer = {}
+        self.spill_paths = None
+        self.unpaired_num = 0
+
+    def add(self, read):
+
+        '''
+        Returns (passed, reference_name, umi) once both mates have been added, otherwise None.
+        '''
+
+        if read.flags & 0x900:
+            return None
+
+        mate1 = read.flags & 0x40 > 0
+
+        if mate1:
+            passed = hasattr(read, 'NM') and read.read_passed(ReadPair.edit_distance_r1, ReadPair.min_matches_r1)
+        else:
+            passed = hasattr(read, 'NM') and read.read_passed(ReadPair.edit_distance_r2, ReadPair.min_matches_r2)
+
+        read_id = read.read_id
+        mate = self.buffer.pop(read_id, None)
+        read = tuple([mate1, passed, read.reference_name, read.umi])
+
+        if mate is not None:
+            return self.pair(mate, read)
+
+        self.buffer[read_id] = read
+
+        if len(self.buffer) >= self.max_reads:
+            self.spill()
+
+        return None
+
+    def pair(self, a, b):
+
+        r1, r2 = (b, a) if b[0] and not a[0] else (a, b)
+
+        return tuple([r1[1] and r2[1] and r1[2] == r2[2], r1[2], r1[3]])
+
+    def spill(self):
+
+        if self.spill_dir is None:
+            raise Exception('Please provide a temporary directory for the mate buffer')
+
+        if self.spill_paths is None:
+            self.spill_paths = [os.path.join(self.spill_dir, f'mate_spill_{os.getpid()}_{id(self)}_{n}.pkl') for n in range(self.bucket_num)]
+
+        bucket_reads = [[] for n in range(self.bucket_num)]
+
+        for read_id, read in self.buffer.items():
+            bucket_reads[zlib.crc32(read_id.encode('utf-8')) % self.bucket_num].append(tuple([read_id, read]))
+
+        for b, reads in enumerate(bucket_reads):
+            if len(reads) > 0:
+                with open(self.spill_paths[b], 'ab') as f:
+                    pickle.dump(reads, f)
+
+        self.buffer = {}
+
+    def flush(self):
+
+        '''
+        Yields the pairs whose mates were spilled and counts the mates that were never paired.
+        '''
+
+        if self.spill_paths is None:
+            self.unpaired_num += len(self.buffer)
+            self.buffer = {}
+            return
+
+        self.spill()
+
+        for fpath in self.spill_paths:
+            if not os.path.exists(fpath):
+                continue
+
+            waiting = {}
+
+            with open(fpath, 'rb') as f:
+                while True:
+                    try:
+                        reads = pickle.load(f)
+                    except EOFError:
+                        break
+
+                    for read_id, read in reads:
+                        mate = waiting.pop(read_id, None)
+                        if mate is None:
+                            waiting[read_id] = read
+                        else:
+                            yield self.pair(mate, read)
+
+            self.unpaired_num += len(waiting)
+            os.remove(fpath)
+
+        self.spill_paths = None
+
+
+class Sam_Block:
+
+    '''
+    Columnar view of a block of SAM records. Records are matched with a single regex pass over the raw bytes,
+    only the fields used by the read filter are kept and reference names are stored as indices into a shared
+    reference lookup. Records without an NM tag never pass the filter and are dropped here.
+    '''
+
+    __slots__ = ('read_num', 'umis', 'flags', 'reference_idx', 'matches', 'NM')
+
+    def __init__(self, block, reference_lookup, cigar_lookup, references):
+
+        self.read_num = block.count(b'\n')
+        records = SAM_RE.findall(block)
+
+        if len(records) == 0:
+            self.umis = []
+            self.flags, self.reference_idx, self.matches, self.NM = [np.zeros(0, dtype = np.int32) for n in range(4)]
+            return
+
+        umis, flags, reference_names, cigars, nm = zip(*records)
+
+        reference_names, reference_idx = np.unique(np.array(reference_names), return_inverse = True)
+        for r in reference_names.tolist():
+            if r not in reference_lookup:
+                reference_lookup[r] = len(reference_lookup)
+                references.append(r.decode('utf-8'))
+
+        cigars, cigar_idx = np.unique(np.array(cigars), return_inverse = True)
+        for c in cigars.tolist():
+            if c not in cigar_lookup:
+                cigar_lookup[c] = sum(int(n) for n, op in CIGAR_RE.findall(c.decode('utf-8')) if op == 'M')
+
+        self.umis = umis
+        self.flags = np.array(flags).astype(np.int32)
+        self.reference_idx = np.array([reference_lookup[r] for r in reference_names.tolist()], dtype = np.int32)[reference_idx.ravel()]
+        self.matches = np.array([cigar_lookup[c] for c in cigars.tolist()], dtype = np.int32)[cigar_idx.ravel()]
+        self.NM = np.array(nm).astype(np.int32)
+
+    def read_passed(self, edit_distance, min_matches):
+        return (edit_distance > self.NM) & (min_matches >= self.matches)
+
+    def __len__(self):
+        return len(self.umis)
+
+
+#reference_lookup maps reference names to their index, references holds the decoded names in index order, both are filled as blocks are read
+
+def iter_sam_blocks(fpath, ftype, reference_lookup, references):
 
-    ftype = '.'.join(fpath.split('.')[1:])
-    reporter_dic = {}
-    
     sproc_dict = {
         'bam' : ['samtools','view', fpath],
         'sam' : ['cat', fpath],
@@ -155,91 +454,560 @@ def read_accepted_hits(fpath):
         raise Exception(f'File type {ftype} not valid')
 
     proc = subprocess.Popen(sproc_dict[ftype], stdout= subprocess.PIPE)
-    run_name = fpath.split('/')[-3]
+    cigar_lookup = {}
+    remainder = b''
+    header = True
+
+    while True:
+        chunk = proc.stdout.read(block_size)
+        if len(chunk) == 0:
+            break
+
+        chunk = remainder + chunk
+        end = chunk.rfind(b'\n') + 1
+        block, remainder = chunk[:end], chunk[end:]
+
+        if header:
+            pos = 0
+            while block.startswith(b'@', pos):
+                end = block.index(b'\n', pos) + 1
+                if block.startswith(b'@PG', pos):
+                    check_paired_end(block[pos:end].decode('utf-8').split('CL:')[-1], ftype)
+                pos = end
+            block = block[pos:]
+            header = len(block) == 0
+
+        yield Sam_Block(block, reference_lookup, cigar_lookup, references)
+
+    if len(remainder) > 0:
+        yield Sam_Block(remainder + b'\n', reference_lookup, cigar_lookup, references)
+
+
+def new_collector():
+    return count_unique.Umi_collector(memory_budget = memory_budget, spill_dir = tmp_path)
+
+
+def count_sam_blocks(fpath, ftype, profile = None):
+
+    profile = Stage_profile(fpath) if profile is None else profile
+    collector = new_collector()
+    reference_lookup, references = {}, []
+    read_num = 0
+
+    for block in profile.timed(iter_sam_blocks(fpath, ftype, reference_lookup, references), 'read'):
+        with profile.stage('filter'):
+            read_num += block.read_num
+            umis = block.umis
+
+            passed = np.flatnonzero(block.read_passed(Aligned_Read.edit_distance, Aligned_Read.min_matches))
+            profile.passed_num += len(passed)
+
+            if len(passed) == 0:
+                continue
+
+            #the passed reads are grouped by reference in order of first appearance and handed to the collector per reference
+            packed = count_unique.pack_umis_bytes(umis)[passed]
+            reference_idx = block.reference_idx[passed]
+            order = np.argsort(reference_idx, kind = 'stable')
+            group_idx, group_start = np.unique(reference_idx[order], return_index = True)
+            group_end = np.append(group_start[1:], len(order))
 
-    mapped_read = ReadPair() if paired_end else Aligned_Read()
+            for g in np.argsort(order[group_start], kind = 'stable').tolist():
+                rows = order[group_start[g]:group_end[g]]
+                reference = references[group_idx[g]]
+                valid = packed[rows] >= 0
+                collector.add_packed(reference, packed[rows[valid]])
 
+                for i in passed[rows[~valid]].tolist():
+                    collector.add(reference, umis[i])
+
+    profile.read_num += read_num
+
+    return collector, read_num
+
+
+def check_paired_end(bowtie2_cl, ftype):
+
+    paired_end_status = '-1' in bowtie2_cl and '-2' in bowtie2_cl 
+    if paired_end_status != paired_end:
+        raise Exception(f'The {ftype} file does not match the paired end specification. Please review the command used to generate the mapped reads {bowtie2_cl}.')        
+
+
+def iter_sam_text(fpath, ftype):
+
+    sproc_dict = {
+        'bam' : ['samtools','view', fpath],
+        'sam' : ['cat', fpath],
+        'sam.zst' : ['zstdcat', fpath]      
+    }
+
+    if ftype not in sproc_dict:
+        raise Exception(f'File type {ftype} not valid')
+
+    proc = subprocess.Popen(sproc_dict[ftype], stdout= subprocess.PIPE)
 
     for l in proc.stdout:
         l = l.decode('utf-8')
         if l.startswith('@'):
             if l.startswith('@PG'):
-                bowtie2_cl = l.split('CL:')[-1]
-                paired_end_status = '-1' in bowtie2_cl and '-2' in bowtie2_cl 
-                if paired_end_status != paired_end:
-                    raise Exception(f'The {ftype} file does not match the paired end specification. Please review the command used to generate the mapped reads {bowtie2_cl}.')        
+                check_paired_end(l.split('CL:')[-1], ftype)
+        else:
+            read = Aligned_Read()
+            read.add_read(l)
+            yield read
+
+
+def iter_sam_binary(fpath, ftype, contigs = None):
+
+    #htslib decodes the binary records directly, only the fields used by the filter are pulled into python
+
+    if pysam is None:
+        raise Exception('pysam is required for the binary reader. Install pysam or use --reader text')
+
+    if ftype not in ['bam', 'sam']:
+        raise Exception(f'File type {ftype} not valid for the binary reader')
+
+    mode = 'rb' if ftype == 'bam' else 'r'
+
+    with pysam.AlignmentFile(fpath, mode, threads = decompression_threads, check_sq = False) as f:
+        for pg in f.header.to_dict().get('PG', []):
+            check_paired_end(pg.get('CL', ''), ftype)
+
+        if contigs is None:
+            segments = f.fetch(until_eof = True)
         else:
-            mapped_read.add_read(l)    
+            segments = (segment for contig in contigs for segment in f.fetch(contig))
+
+        for segment in segments:
+            read = Aligned_Read()
+            read.add_segment(segment)
+            yield read
+
+
+def count_mapped_reads(reads, fpath, profile = None):
+
+    profile = Stage_profile(fpath) if profile is None else profile
+    collector = new_collector()
+    read_num = 0
+    passed_num = 0
+
+    #without profile_reads reading is timed together with the filter
+    if profile_reads:
+        reads = profile.timed(reads, 'read')
+
+    filter_stage = 'filter' if profile_reads else 'read_filter'
+
+    if paired_end:
+        mates = Mate_buffer(spill_dir = tmp_path)
+
+        with profile.stage(filter_stage, exclude = ['read']):
+            for read in reads:
+                read_num += 1
+                pair = mates.add(read)
+                if pair is not None and pair[0]:
+                    passed_num += 1
+                    collector.add(pair[1], pair[2])
+
+        with profile.stage('pair_spilled'):
+            for passed, reference_name, umi in mates.flush():
+                if passed:
+                    passed_num += 1
+                    collector.add(reference_name, umi)
+
+        if mates.unpaired_num > 0:
+            print(f'{mates.unpaired_num} reads without a mate, file: {fpath}')
+
+        profile.read_num += read_num
+        profile.passed_num += passed_num
+
+        return collector, read_num
+
+    with profile.stage(filter_stage, exclude = ['read']):
+        for read in reads:
+            read_num += 1
 
             try:
-                if mapped_read:
-                    if mapped_read.read_passed():
-                        reporter_id = mapped_read.reference_name
-                        if reporter_id not in reporter_dic:
-                            reporter_dic[reporter_id] = []
-                        reporter_dic[reporter_id].append(mapped_read.umi)
-                    mapped_read = ReadPair() if paired_end else Aligned_Read()
-     
-            except Exception as e:
-                if paired_end:
-                    print(e, f'{e}, file: {fpath}, read_id: {mapped_read.read1.read_id}, {mapped_read.read2.read_id}')
-                    mapped_read.read1 = mapped_read.read2
-                    mapped_read.read2 = None
+                if read and read.read_passed():
+                    passed_num += 1
+                    collector.add(read.reference_name, read.umi)
+            except AttributeError:
                 continue
 
-    file_name = f'{tmp_path}{run_name}_{today}_rawcounts.json'
-    json.dump(reporter_dic, open(file_name,'w'))
+    profile.read_num += read_num
+    profile.passed_num += passed_num
 
-    return file_name
+    return collector, read_num
 
 
+def read_accepted_hits(fpath, profile = None):
 
-def read_fasta(fpath):
+    profile = Stage_profile(fpath) if profile is None else profile
+    ftype = '.'.join(fpath.split('.')[1:])
+    run_name = fpath.split('/')[-3]
+    start = time.perf_counter()
 
-    reporter_dic = {}
+    if reader == 'binary' and ftype in ['bam', 'sam']:
+        collector, read_num = count_mapped_reads(iter_sam_binary(fpath, ftype), fpath, profile = profile)
+    elif paired_end:
+        collector, read_num = count_mapped_reads(iter_sam_text(fpath, ftype), fpath, profile = profile)
+    else:
+        collector, read_num = count_sam_blocks(fpath, ftype, profile = profile)
 
-    f = subprocess.Popen(['zstd', '-d', '-f', '-c',fpath], stdout= subprocess.PIPE)
-    f = f.stdout 
+    with profile.stage('collapse'):
+        count_dic = collector.counts()
 
-    run_name = fpath.split('/')[-1].split('_')[0]
-    print(run_name)
+    elapsed = time.perf_counter() - start
+    print(f'{run_name}: {read_num} reads in {elapsed:.1f} s ({read_num / max(elapsed, 1e-9):.0f} reads/s), file: {fpath}')
 
-    for i,l in enumerate(f):
-        l = l.decode('utf-8')
+    return run_name.split('_')[0], count_dic
 
-        if i % 4 == 1:
-            reporter_id = l.strip('\n')
-            
-            if reporter_id in reporter_dic:
-                reporter_dic[reporter_id].append(umi)   
-            else:
-                reporter_dic[reporter_id] = [umi]
 
+def shard_references(fpath):
+
+    '''
+    Splits an indexed BAM into shard_num groups of references (reporters), balanced by the mapped read counts in the index.
+    '''
+
+    if pysam is None:
+        raise Exception('pysam is required for sharded counting')
+
+    with pysam.AlignmentFile(fpath, 'rb') as f:
+        if not f.has_index():
+            raise Exception(f'Sharded counting requires an indexed bam file. Run samtools index {fpath}')
+        index_stats = [(s.contig, s.mapped) for s in f.get_index_statistics()]
+
+    shards = [[] for n in range(shard_num)]
+    shard_reads = [0 for n in range(shard_num)]
+
+    for contig, mapped in sorted(index_stats, key = lambda a:a[1], reverse = True):
+        if mapped == 0:
+            continue
+        i = shard_reads.index(min(shard_reads))
+        shards[i].append(contig)
+        shard_reads[i] += mapped
+
+    return [tuple([fpath, s]) for s in shards if len(s) > 0]
+
+
+def count_shard(shard):
+
+    fpath, contigs = shard
+    profile = Stage_profile(fpath)
+    start = time.perf_counter()
+    collector, read_num = count_mapped_reads(iter_sam_binary(fpath, 'bam', contigs = contigs), fpath, profile = profile)
+
+    with profile.stage('collapse'):
+        count_dic = collector.counts()
+
+    elapsed = time.perf_counter() - start
+    print(f'{len(contigs)} references: {read_num} reads in {elapsed:.1f} s ({read_num / max(elapsed, 1e-9):.0f} reads/s), file: {fpath}')
+
+    return fpath, count_dic, profile.to_dict()
+
+
+def merge_shards(fpath, shard_results):
+
+    #shards hold disjoint references, merging in header order reproduces the single process output of a coordinate sorted bam
+
+    run_name = fpath.split('/')[-3]
+    shard_dic = {}
+
+    for shard_fpath, count_dic in shard_results:
+        if shard_fpath == fpath:
+            shard_dic.update(count_dic)
+
+    with pysam.AlignmentFile(fpath, 'rb') as f:
+        references = f.references
+
+    count_dic = {r: shard_dic[r] for r in references if r in shard_dic}
 
-        elif l.startswith('@'):
-            umi = l.split('#')[-1]
+    return run_name.split('_')[0], count_dic
+
+
+
+def open_decompressed(fpath):
+
+    '''
+    Opens fpath as a binary stream. zstd files are decompressed in-process with python-zstandard, or through a zstd pipe
+    if it is not installed, other files are read as is.
+    '''
+
+    f = open(fpath, 'rb')
+
+    if f.peek(4)[:4] != ZSTD_MAGIC:
+        return f
+
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames = True)
 
     f.close()
 
-    file_name = f'{output_path}{run_name}_{today}_rawcounts.json'
-    json.dump(reporter_dic, open(file_name,'w'))
+    return subprocess.Popen(['zstd', '-d', '-c', fpath], stdout = subprocess.PIPE).stdout
+
+
+def iter_fastq_blocks(fpath):
+
+    '''
+    Reads the decompressed fastq in block_size chunks and yields the header and sequence lines of the complete 4 line
+    records in each chunk as bytes. Lines of a record cut by the chunk boundary are carried over to the next chunk.
+    '''
+
+    remainder = b''
+
+    with open_decompressed(fpath) as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+
+            lines = (remainder + block).split(b'\n')
+            complete = (len(lines) - 1) // 4 * 4
+            remainder = b'\n'.join(lines[complete:])
+
+            yield lines[0:complete:4], lines[1:complete:4]
+
+    if remainder.strip():
+        lines = remainder.split(b'\n')
+        yield lines[0::4], lines[1::4]
+
+
+class Reporter_index:
+
+    '''
+    Assigns read sequences to reporters without alignment. The first prefix_len bases of every reporter in the fasta are
+    indexed exactly, together with the two halves of each prefix: a read prefix with a single mismatch matches one half
+    exactly, so only reporters sharing a half are compared base by base. Prefixes that match more than one reporter at
+    the lowest distance are ambiguous and are not assigned.
+    Reporter names follow build_db.add_reporters: the first word of the header up to the first #.
+    '''
+
+    mismatch_cache_size = 1 << 20
+
+    def __init__(self, fasta_path, prefix_len = None):
+
+        reporters = self.read_reporters(fasta_path)
+
+        if len(reporters) == 0:
+            raise Exception(f'No reporter sequences found in {fasta_path}')
+
+        self.prefix_len = min(len(seq) for name, seq in reporters) if prefix_len is None else prefix_len
+        self.split = self.prefix_len // 2
+        self.exact = {}
+        self.halves = [{}, {}]
+        self.mismatch_cache = {}
+
+        for name, seq in reporters:
+            if len(seq) < self.prefix_len:
+                raise Exception(f'Reporter {name.decode()} is shorter than the prefix length {self.prefix_len}')
+            prefix = seq[:self.prefix_len]
+            if prefix in self.exact:
+                self.exact[prefix] = None
+                continue
+            self.exact[prefix] = name
+            self.halves[0].setdefault(prefix[:self.split], []).append(prefix)
+            self.halves[1].setdefault(prefix[self.split:], []).append(prefix)
+
+        self.digest = hashlib.blake2b(repr(sorted(self.exact.items(), key = lambda a:a[0])).encode(), digest_size = 16).hexdigest()
+
+        ambiguous = sum(1 for name in self.exact.values() if name is None)
+        print(f'{len(reporters)} reporters indexed on {self.prefix_len} nt prefixes, {ambiguous} ambiguous prefixes')
+
+    def read_reporters(self, fasta_path):
+
+        reporters = []
+
+        with open(fasta_path, 'rb') as f:
+            for l in f:
+                l = l.strip()
+                if l.startswith(b'>'):
+                    name = l[1:].split()[0].split(b'#')[0] if len(l) > 1 else b''
+                    reporters.append(tuple([name, []]))
+                elif l:
+                    reporters[-1][1].append(l.upper())
+
+        return [tuple([name, b''.join(seq)]) for name, seq in reporters]
+
+    def match_mismatch(self, prefix):
+
+        candidates = self.halves[0].get(prefix[:self.split], []) + self.halves[1].get(prefix[self.split:], [])
+        match = None
 
-    return file_name
+        for c in set(candidates):
+            if sum(1 for a, b in zip(prefix, c) if a != b) == 1:
+                if match is not None:
+                    return None
+                match = c
 
+        return None if match is None else self.exact[match]
 
-def launch_count_umi(input_path):
+    def get(self, seq):
 
-    subprocess.run(['python',f'{file_path}count_unique.py','-i',input_path], check = True)  
-    output_path = input_path.strip('_rawcounts.json')
-    output_path = output_path + '_counts.json'
-    sample_name = output_path.split('/')[-1].split('_')[0]
-    output_file = json.load(open(output_path,'r'))
+        prefix = seq[:self.prefix_len]
+        name = self.exact.get(prefix, False)
 
+        if name is not False:
+            return name
 
-    os.remove(input_path)
-    os.remove(output_path)
+        if len(prefix) < self.prefix_len:
+            return None
 
-    return sample_name,output_file
+        if prefix not in self.mismatch_cache:
+            if len(self.mismatch_cache) >= self.mismatch_cache_size:
+                self.mismatch_cache = {}
+            self.mismatch_cache[prefix] = self.match_mismatch(prefix)
+
+        return self.mismatch_cache[prefix]
+
+
+def read_fasta(fpath, profile = None):
+
+    profile = Stage_profile(fpath) if profile is None else profile
+    collector = new_collector()
+
+    run_name = fpath.split('/')[-1].split('_')[0]
+    start = time.perf_counter()
+    read_num = 0
+
+    assigned_num = 0
+
+    for headers, sequences in profile.timed(iter_fastq_blocks(fpath), 'read'):
+        with profile.stage('assign'):
+            read_num += len(sequences)
+            for h, seq in zip(headers, sequences):
+                reporter_id = seq if reporter_index is None else reporter_index.get(seq)
+                if reporter_id is None:
+                    continue
+                assigned_num += 1
+                collector.add(reporter_id, h[h.rfind(b'#') + 1:])
+
+    with profile.stage('collapse'):
+        count_dic = {r.decode('utf-8'): c for r, c in collector.counts().items()}
+
+    profile.read_num += read_num
+    profile.passed_num += assigned_num
+
+    elapsed = time.perf_counter() - start
+    print(f'{run_name}: {read_num} reads in {elapsed:.1f} s ({read_num / max(elapsed, 1e-9):.0f} reads/s), file: {fpath}')
+
+    if reporter_index is not None:
+        print(f'{run_name}: {assigned_num} of {read_num} reads assigned to reporters')
+
+    return run_name, count_dic
+
+
+def count_file(file_args):
+
+    fpath, ftype = file_args
+    profile = Stage_profile(fpath)
+
+    if ftype in ['fasta', 'fastq']:
+        return fpath, read_fasta(fpath, profile = profile), profile.to_dict()
+
+    return fpath, read_accepted_hits(fpath, profile = profile), profile.to_dict()
+
+
+def count_files(pool, file_list, ftype):
+
+    '''
+    Yields (fpath, (sample, count_dic), profile) as each file finishes, sharding indexed bams by reference when shard_num > 1.
+    '''
+
+    if ftype == 'bam' and shard_num > 1:
+        shards = [s for f in file_list for s in shard_references(f)]
+        shard_results = {f: [] for f in file_list}
+        shard_profiles = {f: [] for f in file_list}
+        shards_left = {f: 0 for f in file_list}
+        for f, contigs in shards:
+            shards_left[f] += 1
+
+        for f in file_list:
+            if shards_left[f] == 0:
+                yield f, merge_shards(f, []), merge_profiles(f, [])
+
+        for fpath, count_dic, profile in pool.imap_unordered(count_shard, shards):
+            shard_results[fpath].append(tuple([fpath, count_dic]))
+            shard_profiles[fpath].append(profile)
+            shards_left[fpath] -= 1
+            if shards_left[fpath] == 0:
+                yield fpath, merge_shards(fpath, shard_results.pop(fpath)), merge_profiles(fpath, shard_profiles.pop(fpath))
+    else:
+        yield from pool.imap_unordered(count_file, [tuple([f, ftype]) for f in file_list])
+
+
+def hash_file(fpath):
+
+    h = hashlib.blake2b(digest_size = 16)
+
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def cache_keys(pool, file_list, ftype):
+
+    '''
+    Keys each input file by its content hash and the counting parameters. Content hashes are kept in the cache manifest
+    and only recomputed for files whose size or modification time changed.
+    '''
+
+    manifest_path = f'{cache_path}manifest.json'
+    manifest = json.load(open(manifest_path,'r')) if os.path.exists(manifest_path) else {}
+    stats = {f: os.stat(f) for f in file_list}
+
+    to_hash = [f for f in file_list if f not in manifest or manifest[f]['size'] != stats[f].st_size or manifest[f]['mtime'] != stats[f].st_mtime_ns]
+
+    for f, digest in zip(to_hash, pool.map(hash_file, to_hash)):
+        manifest[f] = {'size': stats[f].st_size, 'mtime': stats[f].st_mtime_ns, 'digest': digest}
+
+    if len(to_hash) > 0:
+        write_json_atomic(manifest, manifest_path)
+
+    params = {'ftype': ftype, 'd1': ReadPair.edit_distance_r1, 'm1': ReadPair.min_matches_r1, 'd2': ReadPair.edit_distance_r2, 'm2': ReadPair.min_matches_r2,
+              'paired': paired_end, 'umi_method': count_unique.Umi_counter.method, 'umi_thres': count_unique.Umi_counter.thres,
+              'reporters': None if reporter_index is None else reporter_index.digest}
+
+    keys = {}
+
+    for f in file_list:
+        key_str = json.dumps(params | {'digest': manifest[f]['digest']}, sort_keys = True)
+        keys[f] = hashlib.blake2b(key_str.encode(), digest_size = 16).hexdigest()
+
+    return keys
+
+
+def write_json_atomic(obj, fpath):
+
+    json.dump(obj, open(f'{fpath}.tmp','w'))
+    os.replace(f'{fpath}.tmp', fpath)
+
+
+def count_cached(pool, file_list, ftype):
+
+    '''
+    Counts only the files without a cached result for the current parameters. Each result is written to the cache as
+    soon as its file finishes, so a failed batch resumes from the last completed file.
+    '''
+
+    keys = cache_keys(pool, file_list, ftype)
+    results = {}
+    profiles = {}
+
+    for f in file_list:
+        result_path = f'{cache_path}{keys[f]}.json'
+        if os.path.exists(result_path):
+            results[f] = tuple(json.load(open(result_path,'r')))
+            profiles[f] = {'name': f, 'cached': True}
+
+    print(f'{len(results)} of {len(file_list)} files found in cache: {cache_path}')
+
+    for fpath, result, profile in count_files(pool, [f for f in file_list if f not in results], ftype):
+        write_json_atomic(result, f'{cache_path}{keys[fpath]}.json')
+        results[fpath] = result
+        profiles[fpath] = profile
+
+    return results, profiles
 
 
 def path_test(p):
@@ -259,6 +1027,26 @@ def merge_dic(results):
 
     return assembled_dic
 
+
+def write_count_matrix(reporter_dic, fpath):
+
+    '''
+    Writes {run_name: {reporter_name: count}} as a columnar npz: reporter_names shared by all runs in first seen
+    order, run_names and a (run, reporter) int64 counts matrix.
+    '''
+
+    reporter_idx = {}
+    for count_dic in reporter_dic.values():
+        for r in count_dic:
+            reporter_idx.setdefault(r, len(reporter_idx))
+
+    counts = np.zeros([len(reporter_dic), len(reporter_idx)], dtype = np.int64)
+
+    for n, count_dic in enumerate(reporter_dic.values()):
+        counts[n, [reporter_idx[r] for r in count_dic]] = list(count_dic.values())
+
+    np.savez_compressed(fpath, reporter_names = np.array(list(reporter_idx), dtype = str), run_names = np.array(list(reporter_dic), dtype = str), counts = counts)
+
 #########################################################################################################
 
 
@@ -271,6 +1059,17 @@ if __name__ == '__main__':
     parser.add_argument('-t',type = str, help = 'temporary directory')
     parser.add_argument('-p',type = int, help = 'number of processors')
     parser.add_argument('--paired', action = 'store_true', help = 'does the sam file contain paired end mapped reads')
+    parser.add_argument('--reader', type = str, default = 'text', choices = ['text', 'binary'], help = 'text: samtools/zstdcat pipe, binary: pysam/htslib record reader (bam, sam)')
+    parser.add_argument('--threads', type = int, default = 1, help = 'htslib decompression threads per file for the binary reader')
+    parser.add_argument('--shards', type = int, default = 1, help = 'split each indexed bam into this many reference shards counted in parallel (binary reader)')
+    parser.add_argument('--umi_method', type = str, default = 'heuristic', choices = count_unique.Umi_counter.methods, help = 'UMI clustering method')
+    parser.add_argument('--memory_budget', type = float, default = None, help = 'GB of collected UMIs per worker before spilling to the temporary directory')
+    parser.add_argument('--format', type = str, default = 'json', choices = ['json', 'npz'], help = 'json: nested run/reporter counts, npz: reporter names, run names and a counts matrix')
+    parser.add_argument('--cache', type = str, default = None, help = 'directory of per-file counts keyed by file content and counting parameters, files already counted are skipped')
+    parser.add_argument('--reporters', type = str, default = None, help = 'reporter fasta, assigns fasta/fastq reads to reporters by sequence instead of using the read sequence as the reporter')
+    parser.add_argument('--prefix_len', type = int, default = None, help = 'number of leading bases matched against the reporters, defaults to the shortest reporter')
+    parser.add_argument('--profile_reads', action = 'store_true', help = 'time reading separately from filtering for every read of the per-read parsers, slows them down')
+    parser.add_argument('--mate_buffer', type = int, default = 1 << 22, help = 'number of unpaired mates held in memory before spilling to the temporary directory (--paired)')
     parser.add_argument('-d1',type = int, default= 100, help = 'edit distance')
     parser.add_argument('-m1', type = int, default = 10, help = 'minimum matches')
     parser.add_argument('-d2',type = int, default= 100, help = 'edit distance')
@@ -285,6 +1084,19 @@ if __name__ == '__main__':
     tmp_path = path_test(args.t)
 
     paired_end = args.paired
+    reader = args.reader
+    decompression_threads = args.threads
+    shard_num = args.shards
+    mate_buffer_size = args.mate_buffer
+    profile_reads = args.profile_reads
+    memory_budget = None if args.memory_budget is None else int(args.memory_budget * 1e9)
+    count_unique.Umi_counter.method = args.umi_method
+    run_profile = Stage_profile(args.i)
+
+    with run_profile.stage('reporter_index'):
+        reporter_index = None if args.reporters is None else Reporter_index(args.reporters, prefix_len = args.prefix_len)
+
+    cache_path = None if args.cache is None else path_test(os.path.join(args.cache, ''))
 
     Aligned_Read.edit_distance = args.d1
     Aligned_Read.min_matches = args.m1
@@ -305,17 +1117,33 @@ if __name__ == '__main__':
 
     #need to fix this ...
 
-    with multiprocessing.Pool(proc_num) as pool:
-        if ftype == 'sam.zst' or ftype == 'bam' or ftype == 'sam':
-            results = pool.map(read_accepted_hits,file_list)  
-        elif ftype == 'fasta':
-            results = pool.map(read_fasta,file_list)
+    if ftype not in ['sam.zst', 'bam', 'sam', 'fasta', 'fastq']:
+        raise Exception(f'File type {ftype} not valid')
+
+    with run_profile.stage('count'), multiprocessing.Pool(proc_num) as pool:
+        if cache_path is None:
+            results = {}
+            profiles = {}
+            for fpath, result, profile in count_files(pool, file_list, ftype):
+                results[fpath] = result
+                profiles[fpath] = profile
         else:
-            raise Exception(f'File type {ftype} not valid')
+            results, profiles = count_cached(pool, file_list, ftype)
+
 
-        results = pool.map(launch_count_umi,results)   
-     
+    reporter_dic = merge_dic([results[f] for f in file_list])
+
+    with run_profile.stage('write'):
+        if args.format == 'npz':
+            write_count_matrix(reporter_dic, f'{output_path}{experiment_id}_{today}_counts.npz')
+        else:
+            json.dump(reporter_dic, open(f'{output_path}{experiment_id}_{today}_counts.json','w'))
 
-    reporter_dic = merge_dic(results)
+    files = [profiles[f] for f in file_list]
+    run_profile.read_num = sum(p.get('reads', 0) for p in files)
+    run_profile.passed_num = sum(p.get('passed', 0) for p in files)
+    run_profile.bytes_read = sum(p.get('bytes_read', 0) for p in files)
+    run = run_profile.to_dict()
+    run['peak_rss_mb_workers'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
 
-    json.dump(reporter_dic, open(f'{output_path}{experiment_id}_{today}_counts.json','w'))
\ No newline at end of file
+    json.dump({'run': run, 'files': files}, open(f'{output_path}{experiment_id}_{today}_counts.profile.json','w'), indent = 1)
\ No newline at end of file
@@ -1,38 +1,285 @@
 #!/usr/bin/env python
 
 import argparse
-import json 
+import array
+import json
+import os
+import pickle
+import zlib
+
+import numpy as np
+
+
+UMI_TABLE = str.maketrans('ACGT', '0123')
+UMI_BYTES_TABLE = bytes.maketrans(b'ACGT', b'0123')
+PACKED_TABLE = str.maketrans('0123', 'ACGT')
+
+#ambiguous IUPAC bases are valid UMI characters that cannot be packed, any other character outside ACGT is an error
+UMI_AMBIGUOUS = 'NRYKMSWBDHV'
+UMI_DELETE_TABLE = str.maketrans('', '', 'ACGT' + UMI_AMBIGUOUS)
+UMI_BYTES_DELETE = ('ACGT' + UMI_AMBIGUOUS).encode('ascii')
+
+#2-bit code of every byte value, 254 for ambiguous bases and 255 for invalid bytes
+UMI_CODES = np.full(256, 255, dtype = np.uint8)
+UMI_CODES[np.frombuffer(UMI_AMBIGUOUS.encode('ascii'), dtype = np.uint8)] = 254
+UMI_CODES[np.frombuffer(b'ACGT', dtype = np.uint8)] = np.arange(4, dtype = np.uint8)
+
+
+def pack_umi(umi):
+
+    '''
+    Packs an ACGT UMI into an integer, 2 bits per base behind a leading 1 bit that keeps the UMI length.
+    For UMIs of equal length the numeric order of the packed integers is the lexicographic order of the sequences.
+    Returns -1 for UMIs that cannot be packed into a uint32 (ambiguous bases such as N or longer than 15 nt). Raises for
+    characters that are not bases (e.g. whitespace, a trailing newline or separators), which int() would otherwise accept.
+    '''
+
+    if type(umi) == bytes:
+        if len(umi.translate(None, UMI_BYTES_DELETE)) != 0:
+            raise Exception(f'Invalid UMI {umi!r}, UMIs can only contain ACGT or ambiguous bases ({UMI_AMBIGUOUS})')
+        translated = b'1' + umi.translate(UMI_BYTES_TABLE)
+    else:
+        if len(umi.translate(UMI_DELETE_TABLE)) != 0:
+            raise Exception(f'Invalid UMI {umi!r}, UMIs can only contain ACGT or ambiguous bases ({UMI_AMBIGUOUS})')
+        translated = '1' + umi.translate(UMI_TABLE)
+
+    try:
+        packed = int(translated, 4)
+    except ValueError:
+        return -1
+
+    return packed if packed < 4294967296 else -1
+
+
+def pack_umis_bytes(umis):
+
+    '''
+    Packs a sequence of bytes UMIs like pack_umi, vectorised through UMI_CODES when all UMIs have the same length.
+    Returns an int64 array with -1 for UMIs that cannot be packed and raises for UMIs with characters that are not bases.
+    '''
+
+    umi_num = len(umis)
+    lengths = np.fromiter(map(len, umis), dtype = np.int64, count = umi_num)
+
+    if umi_num == 0 or (lengths != lengths[0]).any():
+        return np.array([pack_umi(u) for u in umis], dtype = np.int64)
+
+    umi_len = int(lengths[0])
+
+    codes = UMI_CODES[np.frombuffer(b''.join(umis), dtype = np.uint8)].reshape(umi_num, umi_len)
+
+    if (codes == 255).any():
+        umi = umis[int(np.flatnonzero((codes == 255).any(axis = 1))[0])]
+        raise Exception(f'Invalid UMI {umi!r}, UMIs can only contain ACGT or ambiguous bases ({UMI_AMBIGUOUS})')
+
+    packed = np.ones(umi_num, dtype = np.int64)
+
+    if umi_len > 15:
+        return np.full(umi_num, -1, dtype = np.int64)
+
+    for n in range(umi_len):
+        packed = (packed << 2) | codes[:,n]
+
+    packed[(codes > 3).any(axis = 1)] = -1
+
+    return packed
+
+
+def unpack_umi(packed):
+    return np.base_repr(packed, 4)[1:].translate(PACKED_TABLE)
+
+
+def pack_umis(umis):
+
+    packed = np.array([pack_umi(u) for u in umis], dtype = np.int64)
+
+    if len(packed) == 0 or packed.min() < 0:
+        return None
+
+    return packed.astype(np.uint32)
+
+
+def umi_length(packed):
+
+    '''Returns the UMI length shared by all packed UMIs, or None if the lengths differ.'''
+
+    umi_len = (int(packed.max()).bit_length() - 1) // 2
+
+    if (int(packed.min()).bit_length() - 1) // 2 != umi_len:
+        return None
+
+    return umi_len
+
+
+def reverse_packed(packed, umi_len):
+
+    reversed_umis = np.zeros_like(packed)
+    x = packed.copy()
+
+    for n in range(umi_len):
+        reversed_umis = (reversed_umis << 2) | (x & 3)
+        x >>= 2
+
+    return reversed_umis | np.uint32(1 << (2 * umi_len))
+
+
+def collapse_packed(packed, read_counts = None):
+
+    '''Returns the unique packed UMIs and their read counts.'''
+
+    if read_counts is None:
+        return np.unique(packed, return_counts = True)
+
+    umis, inverse = np.unique(packed, return_inverse = True)
+    return umis, np.bincount(inverse.ravel(), weights = read_counts, minlength = len(umis)).astype(np.int64)
+
+
+
+def hamming1_pairs_packed(packed, umi_len):
+
+    '''
+    Returns all pairs (i, j) of distinct packed UMIs at Hamming distance 1.
+    Each position is masked in turn, UMIs sharing a masked key differ only at that position, so every pair is found
+    exactly once from n * umi_len keys instead of n^2 comparisons. A masked key is shared by at most 4 UMIs.
+    '''
+
+    pairs_i, pairs_j = [], []
+
+    for pos in range(umi_len):
+        masked = packed & np.uint32(0xFFFFFFFF ^ (3 << (2 * pos)))
+        order = np.argsort(masked, kind = 'stable')
+        sorted_masked = masked[order]
+
+        for d in range(1, 4):
+            same = np.flatnonzero(sorted_masked[d:] == sorted_masked[:-d])
+            pairs_i.append(order[same])
+            pairs_j.append(order[same + d])
+
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def hamming1_pairs_str(umis):
+
+    masked_lookup = {}
+
+    for i, u in enumerate(umis):
+        for pos in range(len(u)):
+            k = tuple([len(u), pos, u[:pos], u[pos + 1:]])
+            if k not in masked_lookup:
+                masked_lookup[k] = []
+            masked_lookup[k].append(i)
+
+    pairs_i, pairs_j = [], []
+
+    for idx in masked_lookup.values():
+        for n, i in enumerate(idx):
+            for j in idx[n + 1:]:
+                pairs_i.append(i)
+                pairs_j.append(j)
+
+    return np.array(pairs_i, dtype = np.int64), np.array(pairs_j, dtype = np.int64)
+
+
+def neighbour_lists(node_num, pairs_i, pairs_j):
+
+    '''Converts an edge list into per-node neighbour lists (CSR offsets and targets).'''
+
+    order = np.argsort(pairs_i, kind = 'stable')
+    targets = pairs_j[order]
+    offsets = np.zeros(node_num + 1, dtype = np.int64)
+    np.cumsum(np.bincount(pairs_i, minlength = node_num), out = offsets[1:])
+
+    return offsets.tolist(), targets.tolist()
+
+
 
 class Umi_counter:
 
+    '''
+    Counts unique molecules among the UMIs of one reporter.
+
+    method = 'heuristic': merges neighbours in forward and reverse sorted order (original NaP-TRAP method).
+    method = 'directional': UMI-tools directional network, a -> b if hd(a, b) == 1 and count(a) >= 2 * count(b) - 1,
+    one molecule per group reachable from the most abundant unassigned UMI.
+    method = 'adjacency': UMI-tools adjacency, per connected Hamming-1 component the fewest most abundant UMIs whose
+    neighbourhoods cover the component.
+    The network methods find all Hamming-1 neighbours with a masked-position index (hamming1_pairs_packed).
+    '''
+
     umi_len = 10
     thres = 1
+    method = 'heuristic'
+    methods = ['heuristic', 'directional', 'adjacency']
+
+    def __init__(self, seq_list, read_counts = None):
+
+        '''
+        seq_list is a list of UMI sequences, a {umi: read_count} dict or a uint32 array of packed UMIs (see pack_umi).
+        Packed UMIs of a single length are clustered on integer keys, anything else falls back to string keys.
+        '''
+
+        if type(seq_list) == dict:
+            read_counts = np.fromiter(seq_list.values(), dtype = np.int64, count = len(seq_list))
+            seq_list = list(seq_list.keys())
+
+        packed = seq_list if isinstance(seq_list, np.ndarray) else pack_umis(seq_list)
+        umi_len = None if packed is None or len(packed) == 0 else umi_length(packed)
+
+        self.packed_len = umi_len
 
-    def __init__(self, seq_list):
+        if umi_len is not None:
+            umis, read_counts = collapse_packed(packed, read_counts)
+            self.umis = umis
+            self.fkeys = umis
+            self.rkeys = reverse_packed(umis, umi_len)
+            self.hd = self.hd_packed
 
-        self.seq_list = seq_list
-        self.umi_dic = {}
+        else:
+            if isinstance(seq_list, np.ndarray):
+                seq_list = [unpack_umi(int(p)) for p in seq_list]
+            umis, inverse = np.unique(np.array(seq_list, dtype = object), return_inverse = True)
+            read_counts = np.bincount(inverse.ravel(), weights = read_counts, minlength = len(umis)).astype(np.int64)
+            self.umis = umis
+            self.fkeys = umis
+            self.rkeys = np.array([u[::-1] for u in umis], dtype = object)
+            self.hd = self.hd_str
 
-        i = 0
-        
-        for seq in self.seq_list:
-            if seq in self.umi_dic:
-                self.umi_dic[seq].read_count += 1
+        self.read_counts = read_counts
+        self.collapsed = np.zeros(len(umis), dtype = bool)
+
+        if self.method == 'heuristic':
+
+            #because we are using 1 as a hamming distance by definition if two sequences are not next to each other on either the forward or reverse sorted they have a hamming distance greater than 1
+
+            self.cluster_umi(np.argsort(self.fkeys, kind = 'stable'))
+            remaining = np.flatnonzero(~self.collapsed)
+            self.cluster_umi(remaining[np.argsort(self.rkeys[remaining], kind = 'stable')])
+            self.cluster_num = int(len(self.collapsed) - self.collapsed.sum())
+
+        elif self.method in self.methods:
+            if self.packed_len is not None:
+                pairs_i, pairs_j = hamming1_pairs_packed(self.umis, self.packed_len)
+            else:
+                pairs_i, pairs_j = hamming1_pairs_str(self.umis.tolist())
+
+            if self.method == 'directional':
+                self.cluster_num = self.cluster_directional(pairs_i, pairs_j)
             else:
-                self.umi_dic[seq] = Umi(seq,i)
-                i += 1
- 
-        #because we are using 1 as a hamming distance by definition if two sequences are not next to each other on either the forward or reverse sorted they have a hamming distance greater than 1
-
-        self.umi_fsorted = sorted(self.umi_dic.values(),key = lambda a:a.seq)
-        self.cluster_umi(self.umi_fsorted)
-        self.umi_rsorted = sorted(self.umi_dic.values(),key = lambda a:a.seq[::-1])
-        self.cluster_umi(self.umi_rsorted)
-
-    def hd(self,x,y):
-        
+                self.cluster_num = self.cluster_adjacency(pairs_i, pairs_j)
+
+        else:
+            raise Exception(f'UMI clustering method {self.method} not valid. Use one of {self.methods}')
+
+    def hd_packed(self, x, y):
+
+        z = x ^ y
+        z = (z | (z >> 1)) & 0x55555555
+        return z.bit_count() <= self.thres + 1
+
+    def hd_str(self, x, y):
+
         d = 0
-        
+
         for bx,by in zip(x,y):
             if bx == by:
                 continue
@@ -42,49 +289,322 @@ class Umi_counter:
 
             else:
                 d += 1
-        
-        return True 
 
-    
-    def cluster_umi(self,sorted_list):
+        return True
+
+
+    def cluster_umi(self, sorted_idx):
+
+        #the first umi is compared against an empty placeholder with a read count of 1, which it always absorbs
+
+        keys = self.fkeys.tolist()
+        read_counts = self.read_counts.tolist()
+        collapsed = self.collapsed
+        umi2 = None
 
-        umi2 = Umi('',-1)
+        for umi1 in sorted_idx.tolist():
 
-        for umi1 in sorted_list:
+            if umi2 is None:
+                read_counts[umi1] += 1
+                umi2 = umi1
 
-            if self.hd(umi1.seq,umi2.seq):
-                
-                if umi1.read_count >= umi2.read_count:
-                    umi1.read_count += umi2.read_count
-                    _ = self.umi_dic.pop(umi2.seq, None)
+            elif self.hd(keys[umi1], keys[umi2]):
+
+                if read_counts[umi1] >= read_counts[umi2]:
+                    read_counts[umi1] += read_counts[umi2]
+                    collapsed[umi2] = True
                     umi2 = umi1
 
                 else:
-                    umi2.read_count += umi1.read_count
-                    _ = self.umi_dic.pop(umi1.seq, None)
-                    
+                    read_counts[umi2] += read_counts[umi1]
+                    collapsed[umi1] = True
+
+        self.read_counts = np.array(read_counts, dtype = np.int64)
+
+    def cluster_directional(self, pairs_i, pairs_j):
+
+        read_counts = self.read_counts
+        node_num = len(read_counts)
+
+        #keep both directions of every pair, then only the edges from an abundant umi to its likely error
+
+        source = np.concatenate([pairs_i, pairs_j])
+        target = np.concatenate([pairs_j, pairs_i])
+        directed = read_counts[source] >= 2 * read_counts[target] - 1
+        offsets, targets = neighbour_lists(node_num, source[directed], target[directed])
+
+        seen = np.zeros(node_num, dtype = bool).tolist()
+        cluster_num = 0
+
+        for node in np.argsort(-read_counts, kind = 'stable').tolist():
+            if seen[node]:
+                continue
+
+            cluster_num += 1
+            seen[node] = True
+            queue = [node]
+
+            while len(queue) > 0:
+                n = queue.pop()
+                for t in targets[offsets[n]:offsets[n + 1]]:
+                    if not seen[t]:
+                        seen[t] = True
+                        queue.append(t)
+
+        return cluster_num
+
+    def cluster_adjacency(self, pairs_i, pairs_j):
+
+        read_counts = self.read_counts
+        node_num = len(read_counts)
+        offsets, targets = neighbour_lists(node_num, np.concatenate([pairs_i, pairs_j]), np.concatenate([pairs_j, pairs_i]))
+        rank = np.argsort(np.argsort(-read_counts, kind = 'stable'), kind = 'stable').tolist()
+
+        seen = np.zeros(node_num, dtype = bool).tolist()
+        cluster_num = 0
+
+        for node in np.argsort(-read_counts, kind = 'stable').tolist():
+            if seen[node]:
+                continue
+
+            component = [node]
+            seen[node] = True
+            queue = [node]
+
+            while len(queue) > 0:
+                n = queue.pop()
+                for t in targets[offsets[n]:offsets[n + 1]]:
+                    if not seen[t]:
+                        seen[t] = True
+                        component.append(t)
+                        queue.append(t)
+
+            component = sorted(component, key = lambda a:rank[a])
+            covered = set()
+
+            for n in component:
+                covered.add(n)
+                covered.update(targets[offsets[n]:offsets[n + 1]])
+                cluster_num += 1
+                if len(covered) == len(component):
+                    break
+
+        return cluster_num
+
     @property
     def total_count(self):
-        return len(self.umi_dic.keys())
+        return self.cluster_num
+
+
+class Umi_collector:
+
+    '''
+    Collects UMIs per reporter while reads are streamed, so raw UMI lists never have to be written out.
+    UMIs are stored 2-bit packed in uint32 arrays and collapsed to (umi, read count) arrays with np.unique once a reporter
+    holds compact_size reads. UMIs that cannot be packed are kept as strings in a per-reporter dict.
+    If memory_budget (bytes) is set and the estimated size of the stored UMIs exceeds it, the collected UMIs are spilled
+    to bucket files in spill_dir partitioned by reporter, and each bucket is collapsed independently in counts().
+    '''
+
+    bucket_num = 64
+    compact_size = 1 << 20
+    str_umi_bytes = 120
 
+    def __init__(self, memory_budget = None, spill_dir = None):
+
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.reporter_dic = {}
+        self.reporter_order = {}
+        self.memory_used = 0
+        self.spill_paths = None
+
+    def get_entry(self, reporter_id):
+
+        entry = self.reporter_dic.get(reporter_id)
+
+        if entry is None:
+            entry = self.reporter_dic[reporter_id] = [array.array('I'), None, None, None]
+            if reporter_id not in self.reporter_order:
+                self.reporter_order[reporter_id] = len(self.reporter_order)
+
+        return entry
+
+    def add(self, reporter_id, umi):
+
+        entry = self.get_entry(reporter_id)
+        packed = pack_umi(umi)
+
+        if packed >= 0:
+            entry[0].append(packed)
+            self.memory_used += 4
+            if len(entry[0]) >= self.compact_size:
+                self.compact(entry)
+
+        else:
+            umi = umi.decode('utf-8') if type(umi) == bytes else umi
+            if entry[3] is None:
+                entry[3] = {}
+            if umi in entry[3]:
+                entry[3][umi] += 1
+            else:
+                entry[3][umi] = 1
+                self.memory_used += self.str_umi_bytes
 
-class Umi:
+        if self.memory_budget is not None and self.memory_used > self.memory_budget:
+            self.spill()
 
-    def __init__(self,seq,idx):
+    def add_packed(self, reporter_id, packed):
 
-        self.seq = seq
-        self.read_count = 1
+        '''
+        Adds an array of packed UMIs (see pack_umis_bytes, all >= 0) of one reporter at once.
+        '''
+
+        entry = self.get_entry(reporter_id)
+        entry[0].frombytes(np.asarray(packed, dtype = np.uint32).tobytes())
+        self.memory_used += 4 * len(packed)
+
+        if len(entry[0]) >= self.compact_size:
+            self.compact(entry)
+
+        if self.memory_budget is not None and self.memory_used > self.memory_budget:
+            self.spill()
+
+    def compact(self, entry):
+
+        raw, umis, read_counts, _ = entry
+        packed = np.frombuffer(raw, dtype = np.uint32)
+
+        if umis is None:
+            umis, read_counts = collapse_packed(packed)
+        else:
+            self.memory_used -= umis.nbytes + read_counts.nbytes
+            umis, read_counts = collapse_packed(np.concatenate([umis, packed]), np.concatenate([read_counts, np.ones(len(packed), dtype = np.int64)]))
+
+        self.memory_used += umis.nbytes + read_counts.nbytes - packed.nbytes
+        entry[:3] = [array.array('I'), umis, read_counts]
+
+    def bucket(self, reporter_id):
+        reporter_id = reporter_id if type(reporter_id) == bytes else reporter_id.encode('utf-8')
+        return zlib.crc32(reporter_id) % self.bucket_num
+
+    def spill(self):
+
+        if self.spill_dir is None:
+            raise Exception('Please provide spill_dir when using a memory budget')
+
+        if self.spill_paths is None:
+            self.spill_paths = [os.path.join(self.spill_dir, f'umi_spill_{os.getpid()}_{id(self)}_{n}.pkl') for n in range(self.bucket_num)]
+
+        bucket_entries = {}
+
+        for reporter_id, entry in self.reporter_dic.items():
+            self.compact(entry)
+            b = self.bucket(reporter_id)
+            if b not in bucket_entries:
+                bucket_entries[b] = []
+            bucket_entries[b].append(tuple([reporter_id, entry[1], entry[2], entry[3]]))
+
+        for b, entries in bucket_entries.items():
+            with open(self.spill_paths[b], 'ab') as f:
+                for e in entries:
+                    pickle.dump(e, f)
+
+        self.reporter_dic = {}
+        self.memory_used = 0
+
+    def load_bucket(self, b):
+
+        reporter_dic = {}
+
+        if not os.path.exists(self.spill_paths[b]):
+            return reporter_dic
+
+        with open(self.spill_paths[b], 'rb') as f:
+            while True:
+                try:
+                    reporter_id, umis, read_counts, str_dic = pickle.load(f)
+                except EOFError:
+                    break
+
+                if reporter_id not in reporter_dic:
+                    reporter_dic[reporter_id] = [array.array('I'), umis, read_counts, str_dic]
+                    continue
+
+                entry = reporter_dic[reporter_id]
+                entry[1], entry[2] = collapse_packed(np.concatenate([entry[1], umis]), np.concatenate([entry[2], read_counts]))
+
+                if str_dic is not None:
+                    entry[3] = {} if entry[3] is None else entry[3]
+                    for umi, read_count in str_dic.items():
+                        entry[3][umi] = entry[3].get(umi, 0) + read_count
+
+        os.remove(self.spill_paths[b])
+
+        return reporter_dic
+
+    def count_entry(self, entry):
+
+        raw, umis, read_counts, str_dic = entry
+        packed = np.frombuffer(raw, dtype = np.uint32)
+
+        if umis is not None:
+            packed = np.concatenate([umis, packed])
+            read_counts = np.concatenate([read_counts, np.ones(len(raw), dtype = np.int64)])
+
+        if str_dic is None:
+            return Umi_counter(packed, read_counts).total_count
+
+        umi_dic = {}
+        read_counts = np.ones(len(packed), dtype = np.int64) if read_counts is None else read_counts
+
+        for p, read_count in zip(packed.tolist(), read_counts.tolist()):
+            umi = unpack_umi(p)
+            umi_dic[umi] = umi_dic.get(umi, 0) + read_count
+
+        for umi, read_count in str_dic.items():
+            umi_dic[umi] = umi_dic.get(umi, 0) + read_count
+
+        return Umi_counter(umi_dic).total_count
+
+    def counts(self):
+
+        '''
+        Collapses the UMIs of every reporter with Umi_counter and returns {reporter_id: unique UMI count} in order of first appearance.
+        '''
+
+        count_dic = {}
+
+        if self.spill_paths is None:
+            for reporter_id, entry in self.reporter_dic.items():
+                count_dic[reporter_id] = self.count_entry(entry)
+        else:
+            self.spill()
+            for b in range(self.bucket_num):
+                for reporter_id, entry in self.load_bucket(b).items():
+                    count_dic[reporter_id] = self.count_entry(entry)
+
+            count_dic = {r: count_dic[r] for r in sorted(count_dic, key = lambda a:self.reporter_order[a])}
+            self.spill_paths = None
+
+        self.reporter_dic = {}
+        self.memory_used = 0
+
+        return count_dic
 
 
 
 #####################################################################################################################################################
 
 if __name__ == '__main__':
-    
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-i',type = str,help = 'input_file_path')
+    parser.add_argument('-m', type = str, default = 'heuristic', choices = Umi_counter.methods, help = 'UMI clustering method')
     args = parser.parse_args()
 
+    Umi_counter.method = args.m
+
     input_path = args.i
     output_path = input_path.strip('_rawcounts.json')
     input_count = json.load(open(input_path,'r'))
@@ -96,4 +616,3 @@ if __name__ == '__main__':
         count_dic[oligo_id] = umi_counter.total_count
 
     json.dump(count_dic,open(f'{output_path}_counts.json','w'))
-